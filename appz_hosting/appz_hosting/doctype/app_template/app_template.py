@@ -4,7 +4,8 @@ App Template DocType - Docker compose templates for one-click deployment
 
 import frappe
 from frappe.model.document import Document
-from jinja2 import Template
+
+from appz_hosting.core import templating
 
 
 class AppTemplate(Document):
@@ -15,13 +16,13 @@ class AppTemplate(Document):
         """Render docker-compose with variables"""
         if not self.docker_compose:
             return None
-        return Template(self.docker_compose).render(**variables)
+        return templating.render(templating.doc_key(self, "docker_compose"), self.docker_compose, **variables)
 
     def render_env(self, variables):
         """Render environment template with variables"""
         if not self.env_template:
             return ""
-        return Template(self.env_template).render(**variables)
+        return templating.render(templating.doc_key(self, "env_template"), self.env_template, **variables)
 
     def get_backup_script(self):
         """Get backup script content"""
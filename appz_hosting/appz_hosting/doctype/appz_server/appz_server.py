@@ -4,31 +4,30 @@ from frappe.model.document import Document
 
 class AppZServer(Document):
     def validate(self):
+        from appz_hosting.core.capacity import load_counters
+
+        load_counters(self)
         self.update_capacity()
 
     def update_capacity(self):
-        """Calculate capacity based on hosted services"""
-        services = frappe.get_all(
-            "Hosted Service",
-            filters={"server": self.name, "status": ["in", ["Active", "Provisioning"]]},
-            fields=["actual_ram_mb", "actual_cpu_percent", "actual_storage_gb"]
-        )
+        """Calculate capacity from the usage counters
 
-        total_ram = sum(s.actual_ram_mb or 0 for s in services) / 1024  # Convert to GB
-        total_cpu = sum(s.actual_cpu_percent or 0 for s in services)
-        total_storage = sum(s.actual_storage_gb or 0 for s in services)
+        The counters are kept current by core.capacity as services change,
+        so saving a server doesn't re-aggregate its services.
+        """
+        ram_pct = (self.used_ram_gb or 0) / self.total_ram_gb * 100 if self.total_ram_gb else 0
+        cpu_pct = (self.used_cpu_cores or 0) / self.total_cpu_cores * 100 if self.total_cpu_cores else 0
+        storage_pct = (self.used_storage_gb or 0) / self.total_storage_gb * 100 if self.total_storage_gb else 0
 
-        self.used_ram_gb = round(total_ram, 2)
-        self.used_cpu_cores = round(total_cpu, 2)
-        self.used_storage_gb = round(total_storage, 2)
-        self.service_count = len(services)
+        self.capacity_percent = round(max(ram_pct, cpu_pct, storage_pct), 1)
 
-        # Calculate overall capacity (weighted average)
-        ram_pct = (total_ram / self.total_ram_gb * 100) if self.total_ram_gb else 0
-        cpu_pct = (total_cpu / self.total_cpu_cores * 100) if self.total_cpu_cores else 0
-        storage_pct = (total_storage / self.total_storage_gb * 100) if self.total_storage_gb else 0
+    @frappe.whitelist()
+    def recount(self):
+        """Recompute the usage counters from this server's services"""
+        from appz_hosting.core.capacity import reconcile_servers
 
-        self.capacity_percent = round(max(ram_pct, cpu_pct, storage_pct), 1)
+        reconcile_servers([self.name])
+        self.reload()
 
     def can_fit(self, ram_mb, cpu_cores, storage_gb):
         """Check if this server can fit additional resources"""
@@ -46,16 +45,19 @@ class AppZServer(Document):
     def refresh_stats(self):
         """Refresh server stats from actual Docker usage"""
         from appz_hosting.core.deployer import Deployer
+        from appz_hosting.core.metrics import record_samples, server_sample
+        from appz_hosting.core.monitoring import server_fields
 
         try:
-            deployer = Deployer(self.name)
-            stats = deployer.get_server_stats()
-
-            self.used_ram_gb = stats.get("used_ram_gb", 0)
-            self.used_cpu_cores = stats.get("used_cpu_cores", 0)
-            self.used_storage_gb = stats.get("used_storage_gb", 0)
-            self.last_health_check = frappe.utils.now()
-            self.save()
+            with Deployer(self.name) as deployer:
+                stats = deployer.get_server_stats()
+
+            # Measured usage only; a full save would race the service counters
+            fields = server_fields("AppZ Server", stats, frappe.utils.now_datetime())
+            frappe.db.set_value("AppZ Server", self.name, fields, update_modified=False)
+            self.update(fields)
+
+            record_samples("AppZ Server", {self.name: server_sample(stats)})
 
             return {"success": True, "stats": stats}
         except Exception as e:
@@ -8,8 +8,10 @@ from frappe.model.document import Document
 
 class CustomerServer(Document):
     def validate(self):
+        from appz_hosting.core.capacity import load_counters
+
+        load_counters(self)
         self.set_pricing()
-        self.update_apps_count()
 
     def set_pricing(self):
         """Set monthly price from plan"""
@@ -18,7 +20,7 @@ class CustomerServer(Document):
             self.monthly_price = plan.price_usd
 
     def update_apps_count(self):
-        """Update count of deployed apps"""
+        """Recount deployed apps (kept current incrementally by core.capacity)"""
         self.apps_count = frappe.db.count(
             "Deployed App", {"server": self.name, "status": ["!=", "Removed"]}
         )
@@ -49,7 +51,7 @@ class CustomerServer(Document):
         """Restart server"""
         from appz_hosting.core.deployer import Deployer
 
-        deployer = Deployer(self.name)
+        deployer = Deployer(self.name, doctype="Customer Server")
         result = deployer._exec("reboot")
         deployer.close()
         return result
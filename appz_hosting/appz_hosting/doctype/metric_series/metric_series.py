@@ -0,0 +1,16 @@
+"""
+Metric Series DocType - Compressed usage history for one server or container
+
+Rows are written in bulk by appz_hosting.core.metrics, never one doc per sample.
+"""
+
+import frappe
+from frappe.model.document import Document
+
+
+class MetricSeries(Document):
+    def get_series(self):
+        """Decode the stored ring buffers"""
+        from appz_hosting.core.metrics import MetricSeries as Series
+
+        return Series.from_blob(self.data)
@@ -0,0 +1,14 @@
+"""
+Service Migration DocType - A Hosted Service moved between AppZ Servers
+
+While Forwarding, the source server's Caddy proxies the service's domain
+to the target until DNS points there; appz_hosting.core.rebalance then
+tears down the source copy and marks the move Completed.
+"""
+
+import frappe
+from frappe.model.document import Document
+
+
+class ServiceMigration(Document):
+    pass
@@ -0,0 +1,254 @@
+"""
+Stats Agent for AppZ Hosting
+
+An optional agent that samples host and per-container usage on the server
+itself and pushes gzip-compressed batches to ingest_stats, so stats don't
+cost an SSH round trip per server per sweep. Servers without a recent push
+keep being polled over SSH.
+"""
+
+import hmac
+import json
+import zlib
+from datetime import timedelta
+
+import frappe
+from frappe.utils import now_datetime
+from frappe.utils.password import get_decrypted_password, set_encrypted_password
+
+from appz_hosting.core.fleet import SSH_KEY_FIELDS
+from appz_hosting.core.metrics import (
+    CONTAINER_METRICS,
+    RESOLUTIONS,
+    SERVER_METRICS,
+    record_batch,
+    server_sample,
+)
+from appz_hosting.core.stats import SAMPLE_SOURCE, server_stats
+
+
+AGENT_DIR = "/opt/appz-agent"
+AGENT_PATH = f"{AGENT_DIR}/agent.py"
+CONFIG_PATH = f"{AGENT_DIR}/config.json"
+UNIT_PATH = "/etc/systemd/system/appz-agent.service"
+
+SAMPLE_INTERVAL = 60  # seconds between samples on the server
+PUSH_INTERVAL = 300  # seconds between pushes
+STALE_AFTER = 3 * PUSH_INTERVAL  # seconds without a push before SSH polling resumes
+MAX_BATCH_BYTES = 8 * 1024 * 1024  # decompressed
+
+# Runs under systemd with the system python3 and only the standard library.
+# Samples are kept in memory while the ingest endpoint is unreachable and
+# sent together on the next successful push.
+AGENT_SCRIPT = SAMPLE_SOURCE + '''
+import gzip, subprocess, urllib.request
+
+CONFIG_PATH = "''' + CONFIG_PATH + '''"
+SPOOL_LIMIT = 2000
+UNITS = {"b": 1, "kb": 1e3, "mb": 1e6, "gb": 1e9, "tb": 1e12,
+         "kib": 1024, "mib": 1024 ** 2, "gib": 1024 ** 3, "tib": 1024 ** 4}
+
+def to_mb(size):
+    size = size.strip().lower()
+    number = size.rstrip("abcdefghijklmnopqrstuvwxyz")
+    return round(float(number) * UNITS.get(size[len(number):].strip(), 1) / 1024 ** 2, 1)
+
+def sample_containers():
+    try:
+        out = subprocess.run(["docker", "stats", "--no-stream", "--format", "{{json .}}"],
+                             capture_output=True, text=True, timeout=60)
+    except Exception:
+        return False, {}
+    if out.returncode != 0:
+        return False, {}
+
+    containers = {}
+    for line in out.stdout.splitlines():
+        try:
+            row = json.loads(line)
+            containers[row["Name"]] = {
+                "ram_mb": to_mb(row["MemUsage"].split("/")[0]),
+                "cpu_percent": float(row["CPUPerc"].rstrip("%") or 0),
+            }
+        except (ValueError, KeyError):
+            continue
+    return True, containers
+
+def push(config, samples):
+    request = urllib.request.Request(
+        config["url"],
+        data=gzip.compress(json.dumps({"samples": samples}).encode()),
+        method="POST",
+        headers={
+            "Content-Type": "application/octet-stream",
+            "X-AppZ-Server": config["server"],
+            "X-AppZ-Doctype": config["doctype"],
+            "X-AppZ-Agent-Token": config["token"],
+        },
+    )
+    urllib.request.urlopen(request, timeout=30).read()
+
+def main():
+    with open(CONFIG_PATH) as f:
+        config = json.load(f)
+
+    pending = []
+    next_push = time.time() + config["push_interval"]
+    while True:
+        started = time.time()
+        docker_up, containers = sample_containers()
+        pending.append({"ts": int(started), "host": sample_server(),
+                        "docker_up": docker_up, "containers": containers})
+
+        if time.time() >= next_push:
+            try:
+                push(config, pending)
+                pending = []
+            except Exception as e:
+                print(f"push failed: {e}", flush=True)
+                del pending[:-SPOOL_LIMIT]
+            next_push = time.time() + config["push_interval"]
+
+        time.sleep(max(0, config["interval"] - (time.time() - started)))
+
+main()
+'''
+
+AGENT_UNIT = f"""[Unit]
+Description=AppZ stats agent
+After=network-online.target docker.service
+
+[Service]
+ExecStart=/usr/bin/python3 {AGENT_PATH}
+Restart=always
+RestartSec=10
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+
+def get_ingest_url():
+    """URL the agent pushes batches to"""
+    return frappe.conf.get("appz_agent_ingest_url") or frappe.utils.get_url(
+        "/api/method/appz_hosting.core.agent.ingest_stats"
+    )
+
+
+def install_agent(deployer):
+    """Install (or reinstall with a fresh token) the stats agent on a server"""
+    server = deployer.server
+    token = frappe.generate_hash(length=32)
+    config = {
+        "url": get_ingest_url(),
+        "server": server.name,
+        "doctype": server.doctype,
+        "token": token,
+        "interval": SAMPLE_INTERVAL,
+        "push_interval": PUSH_INTERVAL,
+    }
+
+    deployer._upload_files({
+        AGENT_PATH: AGENT_SCRIPT,
+        CONFIG_PATH: json.dumps(config, indent=2),
+        UNIT_PATH: AGENT_UNIT,
+    })
+    result = deployer._exec(
+        f"chmod 600 {CONFIG_PATH} && systemctl daemon-reload && "
+        "systemctl enable appz-agent && systemctl restart appz-agent"
+    )
+    if result["exit_code"] != 0:
+        raise Exception(f"Agent install failed: {result['stderr']}")
+
+    set_encrypted_password(server.doctype, server.name, token, "agent_token")
+    return {"success": True}
+
+
+@frappe.whitelist()
+def install_agent_on_server(server_name, doctype="Customer Server"):
+    """Install the stats agent on an existing server"""
+    from appz_hosting.core.deployer import Deployer
+
+    frappe.only_for("System Manager")
+    with Deployer(server_name, doctype=doctype) as deployer:
+        return install_agent(deployer)
+
+
+def get_agent_servers(doctype):
+    """Names of servers whose agent pushed recently enough to skip SSH polling"""
+    cutoff = now_datetime() - timedelta(seconds=STALE_AFTER)
+    return set(frappe.get_all(doctype, filters={"agent_last_push": [">=", cutoff]}, pluck="name"))
+
+
+def _authenticate(doctype, server_name):
+    token = frappe.get_request_header("X-AppZ-Agent-Token") or ""
+    if doctype not in SSH_KEY_FIELDS or not server_name or not token:
+        raise frappe.AuthenticationError("Invalid agent token")
+
+    expected = get_decrypted_password(doctype, server_name, "agent_token", raise_exception=False)
+    if not expected or not hmac.compare_digest(expected, token):
+        raise frappe.AuthenticationError("Invalid agent token")
+
+
+def _decode_batch(body):
+    # Bounded, so a valid token still can't make a worker inflate a zip bomb
+    inflater = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    data = inflater.decompress(body, MAX_BATCH_BYTES)
+    if inflater.unconsumed_tail:
+        raise frappe.ValidationError("Stats batch too large")
+    return json.loads(data).get("samples") or []
+
+
+def _bucket_means(points, step=RESOLUTIONS[0][1]):
+    """Average samples that fall in the same raw bucket of the metric series"""
+    bucketed = {}
+    for entity, entity_points in points.items():
+        buckets = {}
+        for ts, sample in entity_points:
+            buckets.setdefault(int(ts) // step * step, []).append(sample)
+
+        bucketed[entity] = []
+        for ts, samples in sorted(buckets.items()):
+            mean = {}
+            for metric in samples[0]:
+                values = [s[metric] for s in samples if s.get(metric) is not None]
+                mean[metric] = sum(values) / len(values) if values else None
+            bucketed[entity].append((ts, mean))
+    return bucketed
+
+
+@frappe.whitelist(allow_guest=True, methods=["POST"])
+def ingest_stats():
+    """Agent push endpoint: authenticate, update the server record, store every sample"""
+    from appz_hosting.core.monitoring import server_fields
+
+    doctype = frappe.get_request_header("X-AppZ-Doctype") or "Customer Server"
+    server_name = frappe.get_request_header("X-AppZ-Server")
+    _authenticate(doctype, server_name)
+
+    samples = [s for s in _decode_batch(frappe.request.get_data()) if s.get("host")]
+    if not samples:
+        return {"accepted": 0}
+
+    server = None
+    if doctype == "AppZ Server":
+        server = frappe.db.get_value(doctype, server_name, ["total_cpu_cores"], as_dict=True)
+    total_cpu_cores = server.total_cpu_cores if server else None
+
+    points = {}
+    for sample in samples:
+        stats = server_stats(sample["host"], total_cpu_cores)
+        points.setdefault((doctype, server_name), []).append((sample["ts"], server_sample(stats)))
+        for container, values in (sample.get("containers") or {}).items():
+            points.setdefault(("Container", container), []).append((sample["ts"], values))
+    record_batch(_bucket_means(points), {doctype: SERVER_METRICS, "Container": CONTAINER_METRICS})
+
+    latest = max(samples, key=lambda s: s["ts"])
+    fields = server_fields(doctype, server_stats(latest["host"], total_cpu_cores), now_datetime(), server)
+    fields["agent_last_push"] = now_datetime()
+    frappe.db.set_value(doctype, server_name, fields, update_modified=False)
+
+    if latest.get("docker_up") is False:
+        frappe.log_error(f"{doctype} {server_name}: Docker daemon not responding", "Server Health Check")
+
+    return {"accepted": len(samples)}
@@ -2,42 +2,85 @@
 Caddy Configuration Manager for AppZ Hosting
 
 Generates and manages Caddyfile for reverse proxy.
+
+The full Caddyfile is the source of truth on disk and is used to reconcile
+a server. Day-to-day route changes go through Caddy's admin API (a unix
+socket reached over SSH), so only the affected domain's route is touched.
+Servers whose Caddy container still bind-mounts the single Caddyfile are
+moved to the directory mount the first time their config changes; if that
+fails they get full reloads through Caddy's default admin address.
 """
 
+import json
+import shlex
+import time
+
 import frappe
 
+from appz_hosting.core.locks import release, server_semaphore, try_acquire
 
-def generate_caddyfile(server_name):
-    """Generate Caddyfile from all running services on server"""
-    services = frappe.get_all(
-        "Hosted Service",
-        filters={
-            "server": server_name,
-            "status": "Active"
-        },
-        fields=["name", "domain", "plan"]
-    )
 
-    caddyfile = """# Auto-generated by AppZ Hosting
+CADDY_DIR = "/apps/caddy"
+CADDYFILE_PATH = "/apps/caddy/Caddyfile"
+ADMIN_SOCKET = "/apps/caddy/run/admin.sock"  # /run/caddy/admin.sock inside the container
+CONTAINER_ADMIN = "unix//run/caddy/admin.sock"
+LEGACY_ADMIN = "localhost:2019"  # Caddy's default, still used by containers not yet migrated
+ROUTE_ID_PREFIX = "appz-"
+RELOAD_WINDOW = 2  # seconds to collect route changes before one reload
+RELOAD_TIMEOUT = 300  # seconds a caller waits for its change to be applied
+LAYOUT_KEY = "appz_caddy_layout"  # per server: container mounts the config directory
+LAYOUT_CHECK_TTL = 86400  # seconds before a server's mounts are inspected again
+
+CADDY_COMPOSE = """version: "3.8"
+services:
+  caddy:
+    image: caddy:2-alpine
+    container_name: caddy
+    restart: unless-stopped
+    ports:
+      - "80:80"
+      - "443:443"
+      - "443:443/udp"
+    volumes:
+      - /apps/caddy:/etc/caddy:ro
+      - /apps/caddy/run:/run/caddy
+      - /apps/caddy/data:/data
+      - /apps/caddy/config:/config
+    networks:
+      - appz-network
+
+networks:
+  appz-network:
+    external: true
+"""
+
+# Mounts a migrated container has, as "source:destination"
+LAYOUT_MOUNTS = {"/apps/caddy:/etc/caddy", "/apps/caddy/run:/run/caddy"}
+MOUNTS_PROBE = "docker inspect -f '{{range .Mounts}}{{.Source}}:{{.Destination}} {{end}}' caddy"
+
+
+CADDYFILE_HEADER = """# Auto-generated by AppZ Hosting
 # Do not edit manually - changes will be overwritten
 
-{
-    email ssl@appz.studio
-    acme_ca https://acme-v02.api.letsencrypt.org/directory
-}
+"""
 
+ON_DEMAND_TLS = """    tls {
+        on_demand
+    }
 """
 
-    for service in services:
-        plan = frappe.get_doc("Service Plan", service.plan)
-        template = frappe.get_doc("Deployment Template", plan.template)
-        port = template.internal_port or 80
-        container = f"{service.name}-app"
+# With on-demand TLS, hosts without a site block (e.g. routes added through
+# the admin API) still get certificates once the ask endpoint approves them
+ON_DEMAND_CATCH_ALL = """
+https:// {
+""" + ON_DEMAND_TLS + """    respond 404
+}
+"""
 
-        caddyfile += f"""
-# Service: {service.name}
-{service.domain} {{
-    reverse_proxy {container}:{port}
+SITE_BLOCK = """
+# Service: {name}
+{domain} {{
+{tls}    reverse_proxy {name}-app:{port}
     encode gzip
 
     header {{
@@ -48,7 +91,7 @@ def generate_caddyfile(server_name):
     }}
 
     log {{
-        output file /var/log/caddy/{service.domain}.log {{
+        output file /var/log/caddy/{domain}.log {{
             roll_size 10mb
             roll_keep 5
         }}
@@ -57,21 +100,433 @@ def generate_caddyfile(server_name):
 
 """
 
-    return caddyfile
+# A service moved to another server, kept reachable here until its DNS
+# follows. Port 80 passes the new server's HTTP-01 challenges through so it
+# can get its certificate while traffic still arrives at this server.
+FORWARD_SITE_BLOCK = """
+# Moved: {name} -> {target}
+{domain} {{
+{tls}    reverse_proxy https://{target_ip} {{
+        header_up Host {{host}}
+        transport http {{
+            tls_server_name {domain}
+        }}
+    }}
+}}
+
+http://{domain} {{
+    handle /.well-known/acme-challenge/* {{
+        reverse_proxy {target_ip}:80
+    }}
+    handle {{
+        redir https://{{host}}{{uri}} 308
+    }}
+}}
+
+"""
+
+APP_SITE_BLOCK = """
+# App: {name}
+{domain} {{
+{tls}    reverse_proxy 127.0.0.1:{port}
+    encode gzip
+}}
+
+"""
+
+
+def get_route_targets(server_name=None, service_names=None, status="Active"):
+    """Get domain, service name and upstream port for services in one query"""
+    conditions = []
+    values = {}
+    if server_name:
+        conditions.append("hs.server = %(server)s")
+        values["server"] = server_name
+    if service_names is not None:
+        if not service_names:
+            return []
+        conditions.append("hs.name in %(services)s")
+        values["services"] = tuple(service_names)
+    if status:
+        conditions.append("hs.status = %(status)s")
+        values["status"] = status
+
+    return frappe.db.sql(
+        f"""
+        select hs.name, hs.domain, ifnull(nullif(dt.internal_port, 0), 80) as port
+        from `tabHosted Service` hs
+        left join `tabService Plan` sp on sp.name = hs.plan
+        left join `tabDeployment Template` dt on dt.name = sp.template
+        where {" and ".join(conditions) or "1=1"}
+        order by hs.name
+        """,
+        values,
+        as_dict=True,
+    )
+
+
+def get_forwards(server_name):
+    """Domains of services moved off a server that it still forwards"""
+    return frappe.db.sql(
+        """
+        select sm.service as name, sm.domain, sm.target_server as target, srv.ip_address as target_ip
+        from `tabService Migration` sm
+        join `tabAppZ Server` srv on srv.name = sm.target_server
+        where sm.source_server = %s and sm.status in ('Switching', 'Forwarding') and ifnull(sm.domain, '') != ''
+        order by sm.service
+        """,
+        server_name,
+        as_dict=True,
+    )
+
+
+def global_options(admin=None):
+    """Caddyfile global options block"""
+    from appz_hosting.core import tls
+
+    lines = ["{"]
+    if admin:
+        lines.append(f"    admin {admin}")
+    lines.append("    email ssl@appz.studio")
+    lines.append("    acme_ca https://acme-v02.api.letsencrypt.org/directory")
+    if tls.is_enabled():
+        lines.append("    on_demand_tls {")
+        lines.append(f"        ask {tls.get_ask_url()}")
+        lines.append("    }")
+    lines.append("}")
+    return "\n".join(lines) + "\n\n"
+
+
+def _site_tls():
+    from appz_hosting.core import tls
+
+    return ON_DEMAND_TLS if tls.is_enabled() else ""
+
+
+def _catch_all():
+    from appz_hosting.core import tls
+
+    return ON_DEMAND_CATCH_ALL if tls.is_enabled() else ""
+
+
+def generate_caddyfile(server_name, migrated=True):
+    """Generate Caddyfile from all running services on server
+
+    Services that moved off the server keep a forwarding block until their
+    migration completes.
+
+    Containers not yet migrated to the directory mount have no admin socket
+    to move to, so their Caddyfile keeps Caddy's default admin address.
+    """
+    site_tls = _site_tls()
+    parts = [CADDYFILE_HEADER, global_options(admin=CONTAINER_ADMIN if migrated else None)]
+    parts.extend(
+        SITE_BLOCK.format(name=service.name, domain=service.domain, port=service.port, tls=site_tls)
+        for service in get_route_targets(server_name)
+    )
+    parts.extend(
+        FORWARD_SITE_BLOCK.format(tls=site_tls, **forward)
+        for forward in get_forwards(server_name)
+    )
+    parts.append(_catch_all())
+    return "".join(parts)
+
+
+def generate_app_caddyfile(server_name):
+    """Generate Caddyfile for the Deployed Apps on a Customer Server
+
+    Customer Servers run Caddy from the host, so apps are reached through
+    the port each one publishes on localhost.
+    """
+    filters = {
+        "server": server_name,
+        "status": ["not in", ["Removed", "Error"]],
+        "domain": ["is", "set"],
+        "internal_port": [">", 0],
+    }
+
+    apps = frappe.get_all("Deployed App", filters=filters, fields=["name", "domain", "internal_port"], order_by="name")
+
+    site_tls = _site_tls()
+    parts = [CADDYFILE_HEADER, global_options()]
+    parts.extend(
+        APP_SITE_BLOCK.format(name=app.name, domain=app.domain, port=app.internal_port, tls=site_tls)
+        for app in apps
+    )
+    parts.append(_catch_all())
+    return "".join(parts)
+
+
+def has_current_layout(deployer):
+    """Whether the server's Caddy container mounts /apps/caddy as a directory
+
+    Servers set up before uploads went through temp file + rename bind-mount
+    the single Caddyfile, and that mount keeps the old inode after a rename.
+    """
+    cache = frappe.cache()
+    key = f"{LAYOUT_KEY}|{deployer.server.name}"
+    if cache.get_value(key):
+        return True
+
+    result = deployer._exec(MOUNTS_PROBE)
+    current = result["exit_code"] == 0 and LAYOUT_MOUNTS <= set(result["stdout"].split())
+    if current:
+        cache.set_value(key, 1, expires_in_sec=LAYOUT_CHECK_TTL)
+    return current
+
+
+def migrate_layout(deployer):
+    """Recreate an old server's Caddy container with the directory mounts - caller holds the caddy lock"""
+    # The old container still reads the Caddyfile through its single-file
+    # mount, so keep that inode current in case the recreate fails
+    deployer._sync_files(
+        {CADDYFILE_PATH: generate_caddyfile(deployer.server.name)}, force=True, in_place=(CADDYFILE_PATH,)
+    )
+    deployer._sync_files({f"{CADDY_DIR}/docker-compose.yml": CADDY_COMPOSE})
+
+    result = deployer._exec(f"mkdir -p {CADDY_DIR}/run && cd {CADDY_DIR} && docker compose up -d", timeout=300)
+    if result["exit_code"] != 0:
+        raise Exception(f"Recreating Caddy failed: {result['stderr']}")
+    frappe.cache().set_value(f"{LAYOUT_KEY}|{deployer.server.name}", 1, expires_in_sec=LAYOUT_CHECK_TTL)
+
+
+def ensure_layout(deployer):
+    """Migrate the server's Caddy container if needed; returns whether it has the current layout"""
+    if has_current_layout(deployer):
+        return True
+    try:
+        migrate_layout(deployer)
+        return True
+    except Exception as e:
+        frappe.log_error(f"Caddy migration failed on {deployer.server.name}: {e}", "Caddy Routes")
+        return False
+
+
+def write_caddyfile(deployer, caddyfile, migrated, force=False, apply=None):
+    """Sync the Caddyfile; in place on servers that still bind-mount the single file"""
+    in_place = () if migrated else (CADDYFILE_PATH,)
+    return deployer._sync_files({CADDYFILE_PATH: caddyfile}, force=force, in_place=in_place, apply=apply)
+
+
+def reload_caddy(deployer, migrated):
+    """Reload the Caddy container from its Caddyfile, raising if Caddy rejects it"""
+    cmd = "docker exec caddy caddy reload --config /etc/caddy/Caddyfile"
+    if not migrated:
+        # The new config names no admin address, so point at the running one
+        cmd += f" --address {LEGACY_ADMIN}"
+
+    result = deployer._exec(cmd)
+    if result["exit_code"] != 0:
+        raise Exception(f"Caddy reload failed on {deployer.server.name}: {result['stderr'] or result['stdout']}")
+
+
+def sync_and_reload(deployer, migrated, force=False):
+    """Write the full Caddyfile and reload Caddy if it changed - caller holds the caddy lock"""
+    caddyfile = generate_caddyfile(deployer.server.name, migrated=migrated)
+    return bool(write_caddyfile(
+        deployer, caddyfile, migrated, force=force, apply=lambda: reload_caddy(deployer, migrated)
+    ))
+
+
+class CaddyRouteManager:
+    """Adds, replaces and deletes single routes through Caddy's admin API"""
+
+    def __init__(self, deployer):
+        self.deployer = deployer
+        self._server_path = None
+
+    def _request(self, method, path, body=None):
+        # Over a unix socket Caddy (2.7+) only accepts an empty, 127.0.0.1 or ::1 Host
+        cmd = f"curl -sS -f --unix-socket {ADMIN_SOCKET} -X {method} http://127.0.0.1{path}"
+        if body is not None:
+            cmd += f" -H 'Content-Type: application/json' -d {shlex.quote(json.dumps(body))}"
+
+        result = self.deployer._exec(cmd)
+        if result["exit_code"] != 0:
+            raise Exception(f"Caddy admin {method} {path} failed: {result['stderr'] or result['stdout']}")
+        return json.loads(result["stdout"]) if result["stdout"].strip() else None
+
+    def server_path(self):
+        """Config path of the HTTP server that serves the sites (the one on :443)"""
+        if self._server_path is None:
+            servers = self._request("GET", "/config/apps/http/servers") or {}
+            name = next(
+                (n for n, srv in servers.items() if any(l.endswith(":443") for l in srv.get("listen", []))),
+                next(iter(servers), None),
+            )
+            if name is None:
+                raise Exception("Caddy has no HTTP server configured")
+            self._server_path = f"/config/apps/http/servers/{name}"
+        return self._server_path
+
+    def get_routes(self):
+        return self._request("GET", f"{self.server_path()}/routes") or []
+
+    def upsert_route(self, route, routes=None):
+        """Add route, or replace the existing route for the same domain"""
+        routes = self.get_routes() if routes is None else routes
+        index = _find_route(routes, route["match"][0]["host"][0])
+        if index is None:
+            # Insert at the front so host routes stay ahead of any catch-all route
+            self._request("PUT", f"{self.server_path()}/routes/0", route)
+            routes.insert(0, route)
+        else:
+            self._request("PATCH", f"{self.server_path()}/routes/{index}", route)
+            routes[index] = route
+
+    def delete_route(self, domain, routes=None):
+        """Delete the route for domain, if Caddy has one"""
+        routes = self.get_routes() if routes is None else routes
+        index = _find_route(routes, domain)
+        if index is None:
+            return False
+        self._request("DELETE", f"{self.server_path()}/routes/{index}")
+        del routes[index]
+        return True
+
+
+def _find_route(routes, domain):
+    for index, route in enumerate(routes):
+        for match in route.get("match", []):
+            if domain in match.get("host", []):
+                return index
+    return None
+
+
+def build_route(service_name, domain, port):
+    """Admin API route equivalent to a service's Caddyfile site block"""
+    return {
+        "@id": f"{ROUTE_ID_PREFIX}{service_name}",
+        "match": [{"host": [domain]}],
+        "handle": [{
+            "handler": "subroute",
+            "routes": [{
+                "handle": [
+                    {
+                        "handler": "headers",
+                        "response": {
+                            "set": {
+                                "X-Content-Type-Options": ["nosniff"],
+                                "X-Frame-Options": ["SAMEORIGIN"],
+                                "Referrer-Policy": ["strict-origin-when-cross-origin"],
+                            },
+                            "delete": ["Server"],
+                        },
+                    },
+                    {"handler": "encode", "encodings": {"gzip": {}}},
+                    {"handler": "reverse_proxy", "upstreams": [{"dial": f"{service_name}-app:{port}"}]},
+                ],
+            }],
+        }],
+        "terminal": True,
+    }
+
+
+def coalesce_reload(server_name, reload, window=RELOAD_WINDOW, timeout=RELOAD_TIMEOUT):
+    """Run reload for server_name, merged with any other requests in the same window
+
+    Every caller takes a ticket. Whichever caller gets the server's caddy lock
+    waits out the debounce window, notes the newest ticket, runs one reload
+    and marks every ticket up to that one as applied. The others just wait
+    until their ticket is applied, so each caller returns only after a reload
+    that saw its change.
+    """
+    cache = frappe.cache()
+    requested_key = cache.make_key(f"appz_caddy_requested|{server_name}")
+    applied_key = cache.make_key(f"appz_caddy_applied|{server_name}")
+
+    # The reload may run in another worker - it has to see our changes
+    frappe.db.commit()
+    ticket = cache.incr(requested_key)
+    deadline = time.monotonic() + timeout
+
+    while int(cache.get(applied_key) or 0) < ticket:
+        handle = try_acquire(server_name, "caddy", ttl=timeout)
+        if handle:
+            try:
+                time.sleep(window)
+                target = int(cache.get(requested_key))
+                reload()
+                cache.set(applied_key, target)
+            finally:
+                release(handle)
+        elif time.monotonic() > deadline:
+            raise TimeoutError(f"Caddy reload on {server_name} not applied within {timeout}s")
+        else:
+            time.sleep(0.2)
+
+
+def apply_service_routes(deployer, service_names):
+    """Route the given services' domains without a full Caddy reload"""
+    with server_semaphore(deployer.server.name, "caddy", wait=RELOAD_TIMEOUT):
+        migrated = ensure_layout(deployer)
+        if not migrated:
+            # No admin socket to reach - only a full reload applies the change
+            sync_and_reload(deployer, migrated)
+            return
+
+        # Keep the on-disk Caddyfile current so a Caddy restart comes back identical
+        write_caddyfile(deployer, generate_caddyfile(deployer.server.name), migrated)
+
+        try:
+            manager = CaddyRouteManager(deployer)
+            routes = manager.get_routes()
+            for service in get_route_targets(service_names=service_names, status=None):
+                manager.upsert_route(build_route(service.name, service.domain, service.port), routes)
+        except Exception as e:
+            frappe.log_error(f"Incremental route update failed on {deployer.server.name}: {e}", "Caddy Routes")
+            sync_and_reload(deployer, migrated, force=True)
+
+
+def drop_service_route(deployer, service_name):
+    """Remove a service's route without a full Caddy reload"""
+    domain = frappe.db.get_value("Hosted Service", service_name, "domain")
+
+    with server_semaphore(deployer.server.name, "caddy", wait=RELOAD_TIMEOUT):
+        migrated = ensure_layout(deployer)
+        if not migrated:
+            sync_and_reload(deployer, migrated)
+            return
+
+        write_caddyfile(deployer, generate_caddyfile(deployer.server.name), migrated)
+        if not domain:
+            return
+
+        try:
+            CaddyRouteManager(deployer).delete_route(domain)
+        except Exception as e:
+            frappe.log_error(f"Incremental route removal failed on {deployer.server.name}: {e}", "Caddy Routes")
+            sync_and_reload(deployer, migrated, force=True)
+
+
+def reconcile_caddy(deployer):
+    """Regenerate the full Caddyfile and reload Caddy from it"""
+    return deployer._update_caddy(force=True)
 
 
 def add_service_to_caddy(server_name, service_name):
-    """Add a single service to Caddyfile"""
+    """Add a single service to Caddy"""
     from appz_hosting.core.deployer import Deployer
 
-    caddyfile = generate_caddyfile(server_name)
-
-    deployer = Deployer(server_name)
-    deployer._upload_file(caddyfile, "/apps/caddy/Caddyfile")
-    deployer._exec("docker exec caddy caddy reload --config /etc/caddy/Caddyfile")
+    with Deployer(server_name) as deployer:
+        apply_service_routes(deployer, [service_name])
 
 
 def remove_service_from_caddy(server_name, service_name):
-    """Remove a service from Caddyfile"""
-    # Just regenerate without the service
-    add_service_to_caddy(server_name, service_name)
+    """Remove a single service from Caddy"""
+    from appz_hosting.core.deployer import Deployer
+
+    with Deployer(server_name) as deployer:
+        drop_service_route(deployer, service_name)
+
+
+def reconcile_all_servers():
+    """Daily: rebuild every AppZ Server's Caddy config from its Caddyfile"""
+    from appz_hosting.core.deployer import Deployer
+
+    for server_name in frappe.get_all("AppZ Server", filters={"status": "Active"}, pluck="name"):
+        try:
+            with Deployer(server_name) as deployer:
+                reconcile_caddy(deployer)
+        except Exception as e:
+            frappe.log_error(f"Caddy reconciliation failed for {server_name}: {e}", "Caddy Routes")
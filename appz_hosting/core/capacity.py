@@ -0,0 +1,182 @@
+"""
+Capacity Counters for AppZ Hosting
+
+Server counters (app and service counts, summed service usage) are kept
+current with atomic SQL increments as apps and services are created,
+change status or are deleted, instead of being re-aggregated on every
+server save. reconcile_counters recomputes them to correct any drift.
+
+These counters are the only writers of the used_* columns; usage measured
+on the host by the stats sweeps and the agent goes to the host_* columns.
+"""
+
+import frappe
+
+
+COUNTED_SERVICE_STATUSES = ("Active", "Provisioning")
+UNCOUNTED_APP_STATUSES = ("Removed",)
+COUNTER_FIELDS = {
+    "AppZ Server": ("service_count", "used_ram_gb", "used_cpu_cores", "used_storage_gb", "capacity_percent"),
+    "Customer Server": ("apps_count",),
+}
+
+# Utilisation of the scarcest resource, from the row's already-updated values
+_CAPACITY_PERCENT_SQL = """round(greatest(
+    coalesce(used_ram_gb / nullif(total_ram_gb, 0), 0),
+    coalesce(used_cpu_cores / nullif(total_cpu_cores, 0), 0),
+    coalesce(used_storage_gb / nullif(total_storage_gb, 0), 0)
+) * 100, 1)"""
+
+
+def _service_usage(doc):
+    """(server, ram GB, CPU cores, storage GB) a Hosted Service counts for, or None"""
+    if not doc or not doc.get("server") or doc.get("status") not in COUNTED_SERVICE_STATUSES:
+        return None
+    return (
+        doc.server,
+        (doc.get("actual_ram_mb") or 0) / 1024,
+        (doc.get("actual_cpu_percent") or 0) / 100,  # Docker reports 100% per core
+        doc.get("actual_storage_gb") or 0,
+    )
+
+
+def load_counters(doc):
+    """Refresh a server doc's counters from the database before a full save
+
+    A save writes every column, so a doc loaded before concurrent increments
+    would write stale counters back. The row stays locked until the save
+    commits, so those increments wait instead of being lost.
+    """
+    if doc.is_new():
+        return
+    current = frappe.db.get_value(
+        doc.doctype, doc.name, COUNTER_FIELDS[doc.doctype], as_dict=True, for_update=True
+    )
+    if current:
+        doc.update(current)
+
+
+def adjust_server(server_name, services=0, ram_gb=0, cpu_cores=0, storage_gb=0):
+    """Atomically add to an AppZ Server's counters"""
+    frappe.db.sql(
+        f"""
+        update `tabAppZ Server`
+        set service_count = greatest(coalesce(service_count, 0) + %(services)s, 0),
+            used_ram_gb = greatest(coalesce(used_ram_gb, 0) + %(ram_gb)s, 0),
+            used_cpu_cores = greatest(coalesce(used_cpu_cores, 0) + %(cpu_cores)s, 0),
+            used_storage_gb = greatest(coalesce(used_storage_gb, 0) + %(storage_gb)s, 0),
+            capacity_percent = {_CAPACITY_PERCENT_SQL}
+        where name = %(server)s
+        """,
+        {"server": server_name, "services": services, "ram_gb": ram_gb,
+         "cpu_cores": cpu_cores, "storage_gb": storage_gb},
+    )
+
+
+def adjust_apps_count(server_name, delta):
+    """Atomically add to a Customer Server's app count"""
+    frappe.db.sql(
+        """
+        update `tabCustomer Server`
+        set apps_count = greatest(coalesce(apps_count, 0) + %s, 0)
+        where name = %s
+        """,
+        (delta, server_name),
+    )
+
+
+def on_service_change(doc, method=None):
+    """Move a Hosted Service's usage between server counters as it changes"""
+    if method == "on_trash":
+        old, new = _service_usage(doc), None
+    else:
+        old, new = _service_usage(doc.get_doc_before_save()), _service_usage(doc)
+    if old == new:
+        return
+
+    if old:
+        adjust_server(old[0], -1, -old[1], -old[2], -old[3])
+    if new:
+        adjust_server(new[0], 1, new[1], new[2], new[3])
+
+
+def _app_server(doc):
+    """Customer Server a Deployed App counts towards, or None"""
+    if not doc or doc.get("status") in UNCOUNTED_APP_STATUSES:
+        return None
+    return doc.get("server")
+
+
+def on_app_change(doc, method=None):
+    """Keep the Customer Server app count in step with a Deployed App"""
+    if method == "on_trash":
+        old, new = _app_server(doc), None
+    else:
+        old, new = _app_server(doc.get_doc_before_save()), _app_server(doc)
+    if old == new:
+        return
+
+    if old:
+        adjust_apps_count(old, -1)
+    if new:
+        adjust_apps_count(new, 1)
+
+
+def reconcile_counters():
+    """Hourly: recompute every server's counters from its apps and services"""
+    reconcile_servers(frappe.get_all("AppZ Server", pluck="name"))
+
+    apps = dict(frappe.db.sql(
+        """
+        select server, count(*) from `tabDeployed App`
+        where status not in %(statuses)s and server is not null
+        group by server
+        """,
+        {"statuses": UNCOUNTED_APP_STATUSES},
+    ))
+    current = dict(frappe.get_all("Customer Server", fields=["name", "apps_count"], as_list=True))
+    updates = {
+        name: {"apps_count": apps.get(name, 0)}
+        for name, count in current.items()
+        if (count or 0) != apps.get(name, 0)
+    }
+    if updates:
+        frappe.db.bulk_update("Customer Server", updates, update_modified=False)
+    frappe.db.commit()
+
+
+def reconcile_servers(server_names):
+    """Recompute the service counters of some AppZ Servers from their services"""
+    if not server_names:
+        return
+    usage = {
+        row.server: row
+        for row in frappe.db.sql(
+            """
+            select server, count(*) as services,
+                coalesce(sum(actual_ram_mb), 0) / 1024 as ram_gb,
+                coalesce(sum(actual_cpu_percent), 0) / 100 as cpu_cores,
+                coalesce(sum(actual_storage_gb), 0) as storage_gb
+            from `tabHosted Service`
+            where status in %(statuses)s and server in %(servers)s
+            group by server
+            """,
+            {"statuses": COUNTED_SERVICE_STATUSES, "servers": list(server_names)},
+            as_dict=True,
+        )
+    }
+
+    for name in server_names:
+        row = usage.get(name) or frappe._dict(services=0, ram_gb=0, cpu_cores=0, storage_gb=0)
+        frappe.db.sql(
+            f"""
+            update `tabAppZ Server`
+            set service_count = %(services)s,
+                used_ram_gb = round(%(ram_gb)s, 2),
+                used_cpu_cores = round(%(cpu_cores)s, 2),
+                used_storage_gb = round(%(storage_gb)s, 2),
+                capacity_percent = {_CAPACITY_PERCENT_SQL}
+            where name = %(server)s
+            """,
+            dict(row, server=name),
+        )
@@ -0,0 +1,178 @@
+"""
+Adaptive Health Check Scheduling for AppZ Hosting
+
+Every server and client site carries its own next-check time in a Redis
+sorted set. A target that keeps passing backs off towards MAX_INTERVAL; a
+failing, flapping or just-edited target is checked every MIN_INTERVAL. Next
+check times are jittered so checks spread across the interval instead of
+all firing at minute 0.
+"""
+
+import json
+import random
+import time
+
+import frappe
+
+from appz_hosting.core import locks
+from appz_hosting.core.fleet import get_fleet_targets
+
+
+MIN_INTERVAL = 60  # seconds between checks of a failing or changed target
+BASE_INTERVAL = 300  # seconds between checks of a new target
+MAX_INTERVAL = 1800  # seconds between checks of a long-stable target
+BACKOFF = 1.5  # interval growth per consecutive passing check
+JITTER = 0.1  # +/- fraction of the interval
+SYNC_INTERVAL = 300  # seconds between re-reading the target list from the database
+MAX_BATCH = 2000  # targets checked per run
+
+SCHEDULE_KEY = "appz_check_schedule"  # sorted set: target -> next check timestamp
+STATE_KEY = "appz_check_state"  # hash: target -> {"interval", "healthy", "streak"}
+SYNCED_KEY = "appz_check_schedule_synced"
+
+
+def server_target(doctype, server_name):
+    return f"server|{doctype}|{server_name}"
+
+
+def site_target(site_name):
+    return f"site|{site_name}"
+
+
+def next_interval(state, healthy):
+    """Interval until the next check after a result, before jitter"""
+    if not healthy or (state and state["healthy"] is not None and state["healthy"] != healthy):
+        return MIN_INTERVAL
+    interval = state["interval"] if state else BASE_INTERVAL
+    return min(MAX_INTERVAL, max(BASE_INTERVAL, interval * BACKOFF))
+
+
+def _jittered(interval):
+    return interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+def _keys():
+    cache = frappe.cache()
+    return cache, cache.make_key(SCHEDULE_KEY), cache.make_key(STATE_KEY)
+
+
+def sync_targets(force=False):
+    """Add new servers and sites to the schedule and drop removed ones"""
+    cache, schedule_key, state_key = _keys()
+    if not force and cache.get_value(SYNCED_KEY):
+        return
+
+    targets = {server_target(t["doctype"], t["server"]) for t in get_fleet_targets()}
+    targets.update(
+        site_target(name)
+        for name in frappe.get_all("Client Site", filters={"status": "Active"}, pluck="name")
+    )
+
+    scheduled = {frappe.safe_decode(m) for m in cache.zrange(schedule_key, 0, -1)}
+    now = time.time()
+    new = {target: now + random.uniform(0, BASE_INTERVAL) for target in targets - scheduled}
+    if new:
+        cache.zadd(schedule_key, new)
+
+    removed = list(scheduled - targets)
+    if removed:
+        pipe = cache.pipeline()
+        pipe.zrem(schedule_key, *removed)
+        pipe.hdel(state_key, *removed)
+        pipe.execute()
+
+    cache.set_value(SYNCED_KEY, 1, expires_in_sec=SYNC_INTERVAL)
+
+
+def expedite(doc=None, method=None):
+    """Check a server or site on the next run after its address or status changes"""
+    if not (doc.has_value_changed("status") or doc.has_value_changed("ip_address")
+            or doc.has_value_changed("domain")):
+        return
+
+    if doc.doctype == "Client Site":
+        target = site_target(doc.name)
+    else:
+        target = server_target(doc.doctype, doc.name)
+
+    cache, schedule_key, _ = _keys()
+    cache.zadd(schedule_key, {target: time.time()})
+
+
+def get_due_targets(now=None, limit=MAX_BATCH):
+    """Targets whose next check time has passed, most overdue first"""
+    cache, schedule_key, _ = _keys()
+    due = cache.zrangebyscore(schedule_key, "-inf", now or time.time(), start=0, num=limit)
+    return [frappe.safe_decode(m) for m in due]
+
+
+def reschedule(outcomes, now=None):
+    """Store each target's result and set its next check time
+
+    outcomes maps target -> healthy (True/False).
+    """
+    if not outcomes:
+        return
+    cache, schedule_key, state_key = _keys()
+    now = now or time.time()
+
+    states = dict(zip(outcomes, cache.hmget(state_key, list(outcomes))))
+    next_checks = {}
+    new_states = {}
+    for target, healthy in outcomes.items():
+        state = json.loads(states[target]) if states[target] else None
+        interval = next_interval(state, healthy)
+        streak = (state["streak"] + 1) if state and state["healthy"] == healthy else 1
+        next_checks[target] = now + _jittered(interval)
+        new_states[target] = json.dumps({"interval": interval, "healthy": healthy, "streak": streak})
+
+    pipe = cache.pipeline()
+    pipe.zadd(schedule_key, next_checks, xx=True)
+    pipe.hset(state_key, mapping=new_states)
+    pipe.execute()
+
+
+def run_due_checks():
+    """Every minute: check the servers and sites that are due"""
+    from appz_hosting.core.monitoring import HEALTH_PROBE, check_site_list, sweep_servers
+
+    handle = locks.try_acquire("fleet", "health_checks", ttl=600)
+    if handle is None:
+        return  # previous run still going
+
+    try:
+        sync_targets()
+        due = get_due_targets()
+        if not due:
+            return
+
+        servers = {}
+        sites = []
+        for target in due:
+            kind, _, rest = target.partition("|")
+            if kind == "server":
+                doctype, _, name = rest.partition("|")
+                servers.setdefault(doctype, []).append(name)
+            elif kind == "site":
+                sites.append(rest)
+
+        outcomes = {}
+        if servers:
+            targets = [
+                t for doctype, names in servers.items()
+                for t in get_fleet_targets(doctypes=(doctype,), names=names)
+            ]
+            summary = sweep_servers(HEALTH_PROBE, targets=targets)
+            failed = set(summary["failed_servers"])
+            for doctype, names in servers.items():
+                for name in names:
+                    outcomes[server_target(doctype, name)] = f"{doctype}|{name}" not in failed
+
+        if sites:
+            for name, healthy in check_site_list(sites).items():
+                outcomes[site_target(name)] = healthy
+
+        reschedule(outcomes)
+        return {"checked": len(outcomes), "unhealthy": sum(1 for ok in outcomes.values() if not ok)}
+    finally:
+        locks.release(handle)
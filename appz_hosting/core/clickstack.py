@@ -5,7 +5,8 @@ Manages observability addon for customer services.
 """
 
 import frappe
-from jinja2 import Template
+
+from appz_hosting.core import templating
 
 
 OTEL_CONFIG_TEMPLATE = """receivers:
@@ -82,7 +83,9 @@ def enable_clickstack(service_name):
     tenant_id = get_or_create_tenant(service.customer)
 
     # Generate OTel config
-    otel_config = Template(OTEL_CONFIG_TEMPLATE).render(
+    otel_config = templating.render(
+        templating.builtin_key("otel_config"),
+        OTEL_CONFIG_TEMPLATE,
         tenant_id=tenant_id,
         service_id=service.name,
         clickstack_endpoint=frappe.conf.get("clickstack_endpoint", "https://otel.appz.studio")
@@ -92,11 +95,10 @@ def enable_clickstack(service_name):
     from appz_hosting.core.deployer import Deployer
     deployer = Deployer(service.server)
 
-    # Upload OTel config
-    deployer._upload_file(otel_config, f"/apps/{service.name}/otel-config.yaml")
-
     # Add OTel sidecar to compose
-    otel_compose = Template(OTEL_COMPOSE_TEMPLATE).render(
+    otel_compose = templating.render(
+        templating.builtin_key("otel_compose"),
+        OTEL_COMPOSE_TEMPLATE,
         service_id=service.name,
         data_path=f"/apps/{service.name}"
     )
@@ -105,6 +107,8 @@ def enable_clickstack(service_name):
     result = deployer._exec(f"cat /apps/{service.name}/docker-compose.yml")
     existing_compose = result["stdout"]
 
+    files = {f"/apps/{service.name}/otel-config.yaml": otel_config}
+
     # Append OTel service (simple approach - in production, use proper YAML merge)
     if "otel-collector" not in existing_compose:
         # Insert before networks section
@@ -113,8 +117,12 @@ def enable_clickstack(service_name):
             new_compose = parts[0] + otel_compose + "\nnetworks:" + parts[1]
         else:
             new_compose = existing_compose + "\n" + otel_compose
+        files[f"/apps/{service.name}/docker-compose.yml"] = new_compose
 
-        deployer._upload_file(new_compose, f"/apps/{service.name}/docker-compose.yml")
+    # Upload OTel config and compose together
+    deployer._sync_files(files)
+
+    if "otel-collector" not in existing_compose:
         deployer._exec(f"cd /apps/{service.name} && docker compose up -d otel-collector")
 
     # Create Grafana dashboard
@@ -4,66 +4,286 @@ Deployment Engine for AppZ Hosting
 Handles all deployment operations via SSH + Docker Compose.
 """
 
+import asyncio
 import frappe
 import paramiko
 import secrets
 import os
-from jinja2 import Template
+import codecs
+import select
+import shlex
+import socket
+import threading
+import hashlib
+import time
+import json
+from concurrent.futures import ThreadPoolExecutor
+from frappe.utils.password import get_decrypted_password, set_encrypted_password
+
+from appz_hosting.core import capacity, fleet, images, templating
+from appz_hosting.core.locks import server_semaphore
+from appz_hosting.core.ssh_pool import get_pool
+from appz_hosting.core.stats import SERVER_STATS_PROBE, parse_server_stats
+
+STREAM_CHUNK_SIZE = 32768
+REMOTE_HASH_TTL = 86400  # seconds a host's remembered hashes live after its last sync
+REMOTE_HASH_KEY = "appz_remote_hashes"  # per host: remote path -> sha256 of the applied content
+
+APP_PORT_BASE = 10000  # first host port published by Deployed Apps
+APP_PORT_STEP = 10  # ports reserved per app (web, ssh, ...)
+MAX_DEPLOYS_PER_SERVER = 2
+BULK_DEPLOY_PARALLELISM = 3  # compose projects started at once by deploy_services
+HEALTH_TIMEOUT = 180  # seconds to wait for a new app to answer
+DEPLOY_SLOT_WAIT = 600  # seconds an app deployment waits for a deploy slot
+# Slot wait plus the longest each host stage may take: upload, pull, up,
+# health and route, with a margin for rendering and bookkeeping
+DEPLOY_JOB_TIMEOUT = DEPLOY_SLOT_WAIT + 60 + images.PULL_TIMEOUT + 300 + (HEALTH_TIMEOUT + 30) + 300 + 300
+CREDENTIALS_FIELD = "deploy_credentials"  # encrypted per Hosted Service, like agent tokens
+
+# Starts the project only if some of its services aren't running (e.g. after
+# stop_service), for when the compose file itself is unchanged
+COMPOSE_UP_IF_STOPPED = (
+    '[ "$(docker compose ps --services --status running | sort)" = '
+    '"$(docker compose config --services | sort)" ] || docker compose up -d'
+)
 
 
 class Deployer:
     """Handles all deployment operations via SSH"""
 
-    def __init__(self, server_name):
-        self.server = frappe.get_doc("AppZ Server", server_name)
+    def __init__(self, server_name, doctype="AppZ Server"):
+        self.server = frappe.get_doc(doctype, server_name)
+        self.ssh_key = self.server.get(fleet.SSH_KEY_FIELDS[doctype])
         self.ssh = None
+        # deploy_services' threads share self.ssh; only one may replace it
+        self._ssh_lock = threading.RLock()
 
     def _connect(self):
-        """Establish SSH connection"""
-        if self.ssh:
+        """Borrow an SSH connection from the worker's pool"""
+        with self._ssh_lock:
+            if self.ssh:
+                transport = self.ssh.get_transport()
+                if transport is not None and transport.is_active():
+                    return self.ssh
+                # Transport died while we held it - drop it and reconnect
+                self._release(discard=True)
+
+            self.ssh = get_pool().acquire(self.server.ip_address, key_path=self.ssh_key)
             return self.ssh
 
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        key_path = self.server.ssh_key or os.path.expanduser("~/.ssh/id_rsa")
-        key = paramiko.RSAKey.from_private_key_file(key_path)
+    def _release(self, discard=False):
+        """Hand the borrowed SSH connection back to the pool"""
+        with self._ssh_lock:
+            if self.ssh:
+                ssh, self.ssh = self.ssh, None
+                get_pool().release(
+                    self.server.ip_address, ssh, key_path=self.ssh_key, discard=discard
+                )
+
+    def _open_channel(self, cmd, timeout=None, get_pty=False):
+        """Start cmd on a fresh session channel"""
+        ssh = self._connect()
+        try:
+            channel = ssh.get_transport().open_session()
+        except paramiko.SSHException:
+            # Pooled transport went away between checks - retry once on a fresh one
+            with self._ssh_lock:
+                # Another thread may already have replaced it
+                if self.ssh is ssh:
+                    self._release(discard=True)
+                ssh = self._connect()
+            channel = ssh.get_transport().open_session()
+
+        channel.settimeout(timeout)
+        if get_pty:
+            channel.get_pty()
+        channel.exec_command(cmd)
+        return channel
+
+    def _exec_stream(self, cmd, timeout=None, chunk_size=STREAM_CHUNK_SIZE, get_pty=False):
+        """Execute command via SSH, yielding output as it arrives
+
+        Yields ("stdout", text) and ("stderr", text) chunks, then a final
+        ("exit", exit_code). Data is only read off the channel when the caller
+        asks for the next chunk, so a slow consumer throttles the remote side
+        through the SSH window instead of buffering everything in memory.
+        Closing the generator early closes the channel.
+        """
+        channel = self._open_channel(cmd, timeout=timeout, get_pty=get_pty)
+        decoders = {
+            "stdout": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+            "stderr": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+        }
 
-        ssh.connect(
-            self.server.ip_address,
-            username="root",
-            pkey=key,
-            timeout=30
-        )
-        self.ssh = ssh
-        return ssh
+        try:
+            while True:
+                if channel.recv_stderr_ready():
+                    yield "stderr", decoders["stderr"].decode(channel.recv_stderr(chunk_size))
+                elif channel.recv_ready():
+                    yield "stdout", decoders["stdout"].decode(channel.recv(chunk_size))
+                elif channel.eof_received or channel.closed:
+                    # Both buffers are drained and the server has sent EOF, so no
+                    # more output can follow. sshd may send the exit status before
+                    # the last data, so it is only read after this point.
+                    break
+                else:
+                    readable, _, _ = select.select([channel], [], [], timeout)
+                    if not readable:
+                        raise socket.timeout(f"No output from '{cmd}' for {timeout}s")
+
+            for stream, decoder in decoders.items():
+                tail = decoder.decode(b"", final=True)
+                if tail:
+                    yield stream, tail
+            yield "exit", channel.recv_exit_status()
+        finally:
+            channel.close()
 
     def _exec(self, cmd, timeout=60):
         """Execute command via SSH"""
-        ssh = self._connect()
-        stdin, stdout, stderr = ssh.exec_command(cmd, timeout=timeout)
-        exit_code = stdout.channel.recv_exit_status()
+        output = {"stdout": [], "stderr": []}
+        exit_code = None
+        for stream, data in self._exec_stream(cmd, timeout=timeout):
+            if stream == "exit":
+                exit_code = data
+            else:
+                output[stream].append(data)
+
         return {
-            "stdout": stdout.read().decode(),
-            "stderr": stderr.read().decode(),
+            "stdout": "".join(output["stdout"]),
+            "stderr": "".join(output["stderr"]),
             "exit_code": exit_code
         }
 
     def _upload_file(self, local_content, remote_path):
         """Upload file content to server"""
+        self._upload_files({remote_path: local_content})
+
+    async def _exec_async(self, cmd, timeout=60):
+        """_exec for asyncio callers, run in a thread on the pooled connection"""
+        return await asyncio.to_thread(self._exec, cmd, timeout)
+
+    async def _upload_file_async(self, local_content, remote_path):
+        """_upload_file for asyncio callers, run in a thread on the pooled connection"""
+        await asyncio.to_thread(self._upload_file, local_content, remote_path)
+
+    def _upload_files(self, files, in_place=()):
+        """Upload several files over a single SFTP session
+
+        files maps remote path -> content. Each file is written to a temp
+        name next to its target and renamed into place, so Caddy or compose
+        never read a half-written file. Paths in in_place are copied over the
+        existing file instead, keeping its inode for containers that
+        bind-mount that single file.
+        """
+        copies = []
+        pending = []  # temp files not yet moved into place
         ssh = self._connect()
         sftp = ssh.open_sftp()
-
-        # Ensure directory exists
-        remote_dir = os.path.dirname(remote_path)
+        try:
+            known_dirs = set()
+            for remote_path, content in files.items():
+                self._sftp_makedirs(sftp, os.path.dirname(remote_path), known_dirs)
+
+                tmp_path = f"{remote_path}.appz-{secrets.token_hex(4)}"
+                pending.append(tmp_path)
+                with sftp.file(tmp_path, "w") as f:
+                    f.write(content)
+                if remote_path in in_place:
+                    copies.append((tmp_path, remote_path))
+                else:
+                    sftp.posix_rename(tmp_path, remote_path)
+                    pending.remove(tmp_path)
+        except Exception:
+            # Don't leave stray files behind, e.g. in Caddy's config directory
+            for tmp_path in pending:
+                try:
+                    sftp.remove(tmp_path)
+                except (OSError, paramiko.SSHException):
+                    pass
+            raise
+        finally:
+            sftp.close()
+
+        if copies:
+            result = self._exec(" && ".join(
+                f"cat {shlex.quote(tmp)} > {shlex.quote(path)} && rm -f {shlex.quote(tmp)}"
+                for tmp, path in copies
+            ))
+            if result["exit_code"] != 0:
+                self._exec("rm -f " + " ".join(shlex.quote(tmp) for tmp, _ in copies))
+                raise Exception(f"Writing {', '.join(p for _, p in copies)} failed: {result['stderr']}")
+
+    def _sync_files(self, files, force=False, in_place=(), apply=None):
+        """Upload only the files whose content differs from what the server last applied
+
+        Returns the list of remote paths that were written (in_place as for
+        _upload_files). When anything changed, apply() - a reload or compose
+        up - runs next, and the new hashes are recorded only once it has
+        succeeded, so a failed apply is retried on the next sync. Hashes are
+        shared by all workers in Redis; unknown ones are fetched with a single
+        sha256sum call.
+        """
+        cache = frappe.cache()
+        key = self._hashes_key()
+        local = {path: hashlib.sha256(content.encode()).hexdigest() for path, content in files.items()}
+
+        paths = list(files)
+        remote = {
+            path: frappe.safe_decode(digest)
+            for path, digest in zip(paths, cache.hmget(key, paths))
+            if digest is not None
+        }
+        unknown = [path for path in paths if path not in remote]
+
+        if unknown and not force:
+            result = self._exec("sha256sum " + " ".join(shlex.quote(p) for p in unknown) + " 2>/dev/null")
+            for line in result["stdout"].splitlines():
+                digest, _, path = line.partition("  ")
+                remote[path] = digest
+
+        changed = [path for path in files if force or remote.get(path) != local[path]]
+        if changed:
+            # Mark as pending first: if the upload or apply fails, the next
+            # sync must not mistake the file on disk for applied content
+            self._store_hashes({path: "" for path in changed})
+            self._upload_files({path: files[path] for path in changed}, in_place=in_place)
+            if apply:
+                apply()
+
+        self._store_hashes(local)
+        return changed
+
+    def _hashes_key(self):
+        return frappe.cache().make_key(f"{REMOTE_HASH_KEY}|{self.server.ip_address}")
+
+    def _store_hashes(self, hashes):
+        key = self._hashes_key()
+        pipe = frappe.cache().pipeline()
+        pipe.hset(key, mapping=hashes)
+        pipe.expire(key, REMOTE_HASH_TTL)
+        pipe.execute()
+
+    def _forget_hashes(self, prefix):
+        """Drop remembered hashes for remote paths under prefix"""
+        cache = frappe.cache()
+        key = self._hashes_key()
+        paths = [path for path, _ in cache.hscan_iter(key, match=f"{prefix}*")]
+        if paths:
+            pipe = cache.pipeline()
+            pipe.hdel(key, *paths)
+            pipe.execute()
+
+    def _sftp_makedirs(self, sftp, remote_dir, known_dirs):
+        """mkdir -p over an open SFTP session"""
+        if not remote_dir or remote_dir in known_dirs:
+            return
         try:
             sftp.stat(remote_dir)
         except FileNotFoundError:
-            self._exec(f"mkdir -p {remote_dir}")
-
-        with sftp.file(remote_path, "w") as f:
-            f.write(local_content)
-        sftp.close()
+            self._sftp_makedirs(sftp, os.path.dirname(remote_dir), known_dirs)
+            sftp.mkdir(remote_dir)
+        known_dirs.add(remote_dir)
 
     def setup_server(self):
         """Initial server setup - Docker, Caddy, network"""
@@ -86,53 +306,118 @@ class Deployer:
         # Setup Caddy
         self._setup_caddy()
 
+        # Warm template images so the first deploy doesn't wait on pulls
+        frappe.enqueue(
+            "appz_hosting.core.images.warm_server_images",
+            queue="long",
+            timeout=images.WARM_JOB_TIMEOUT,
+            server_name=self.server.name,
+        )
+
         return {"success": True, "message": "Server setup complete"}
 
     def _setup_caddy(self):
         """Setup Caddy reverse proxy"""
-        compose = """version: "3.8"
-services:
-  caddy:
-    image: caddy:2-alpine
-    container_name: caddy
-    restart: unless-stopped
-    ports:
-      - "80:80"
-      - "443:443"
-      - "443:443/udp"
-    volumes:
-      - /apps/caddy/Caddyfile:/etc/caddy/Caddyfile
-      - /apps/caddy/data:/data
-      - /apps/caddy/config:/config
-    networks:
-      - appz-network
+        from appz_hosting.core.caddy import CADDY_COMPOSE
 
-networks:
-  appz-network:
-    external: true
-"""
-        self._upload_file(compose, "/apps/caddy/docker-compose.yml")
-        self._upload_file("# Empty Caddyfile\n", "/apps/caddy/Caddyfile")
-        self._exec("cd /apps/caddy && docker compose up -d")
+        self._sync_files({
+            "/apps/caddy/docker-compose.yml": CADDY_COMPOSE,
+            "/apps/caddy/Caddyfile": "{\n    admin unix//run/caddy/admin.sock\n}\n",
+        })
+        self._exec("mkdir -p /apps/caddy/run && cd /apps/caddy && docker compose up -d")
 
     def deploy_service(self, service_name):
         """Deploy a hosted service"""
+        rendered_compose, credentials = self._render_service(service_name)
+
+        # Pull images the server doesn't have yet (usually warmed in the background)
+        images.ensure_images(self, rendered_compose)
+
+        def compose_up(cmd="docker compose up -d"):
+            result = self._exec(f"cd /apps/{service_name} && {cmd}", timeout=300)
+            if result["exit_code"] != 0:
+                raise Exception(f"Deployment failed: {result['stderr']}")
+
+        # Upload compose file (creates /apps/<service> if needed) and recreate on change
+        if not self._sync_files({f"/apps/{service_name}/docker-compose.yml": rendered_compose}, apply=compose_up):
+            compose_up(COMPOSE_UP_IF_STOPPED)
+
+        # Route the domain
+        from appz_hosting.core.caddy import apply_service_routes
+        apply_service_routes(self, [service_name])
+
+        return {
+            "success": True,
+            "compose": rendered_compose,
+            "credentials": credentials
+        }
+
+    def deploy_services(self, service_names, parallel=BULK_DEPLOY_PARALLELISM):
+        """Deploy several hosted services on this server in one pass
+
+        All compose files go up in one SFTP session and missing images are
+        pulled in one call. Up to `parallel` compose projects start at once,
+        and Caddy is updated once at the end, so the round trips stay
+        constant instead of growing with every service. A service that fails
+        to start is reported on its own; the others still get their routes.
+        """
+        if not service_names:
+            return {"success": True, "services": {}}
+
+        rendered = {name: self._render_service(name) for name in service_names}
+        paths = {name: f"/apps/{name}/docker-compose.yml" for name in service_names}
+
+        images.ensure_images(self, "\n".join(compose for compose, _ in rendered.values()))
+        changed = set(self._sync_files({paths[name]: compose for name, (compose, _) in rendered.items()}))
+
+        def compose_up(name):
+            cmd = "docker compose up -d" if paths[name] in changed else COMPOSE_UP_IF_STOPPED
+            try:
+                return name, self._exec(f"cd /apps/{name} && {cmd}", timeout=300)
+            except Exception as e:
+                return name, {"exit_code": -1, "stderr": str(e) or type(e).__name__}
+
+        # One connection up front; every thread opens its own channel on it
+        self._connect()
+        results = {}
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            for name, result in pool.map(compose_up, service_names):
+                compose, credentials = rendered[name]
+                results[name] = {"success": result["exit_code"] == 0, "compose": compose, "credentials": credentials}
+                if result["exit_code"] != 0:
+                    results[name]["error"] = result["stderr"]
+
+        # Failed projects stay pending so the next deploy brings them up again
+        failed = [paths[name] for name, r in results.items() if not r["success"]]
+        if failed:
+            self._store_hashes({path: "" for path in failed})
+
+        # One route pass for the whole batch
+        from appz_hosting.core.caddy import apply_service_routes
+        started = [name for name, r in results.items() if r["success"]]
+        if started:
+            apply_service_routes(self, started)
+
+        return {
+            "success": all(r["success"] for r in results.values()),
+            "services": results
+        }
+
+    def _render_service(self, service_name):
+        """Render a hosted service's compose file with its stored credentials"""
         service = frappe.get_doc("Hosted Service", service_name)
         plan = frappe.get_doc("Service Plan", service.plan)
         template = frappe.get_doc("Deployment Template", plan.template)
 
-        # Generate credentials
-        credentials = {
-            "db_password": secrets.token_urlsafe(16),
-            "db_root_password": secrets.token_urlsafe(16),
-            "admin_password": secrets.token_urlsafe(12),
-            "encryption_key": secrets.token_urlsafe(32),
-        }
+        credentials = self._service_credentials(service.name)
 
         # Get compose template
         compose_content = template.get_compose_content()
-        if not compose_content:
+        if compose_content:
+            template_key = templating.doc_key(template, "compose")
+        else:
             compose_content = self._get_default_compose(template.name)
+            template_key = templating.builtin_key(template.name)
 
         # Render template
         variables = {
@@ -147,27 +432,27 @@ networks:
             "CPU_LIMIT": str(template.min_cpu),
         }
 
-        rendered_compose = Template(compose_content).render(**variables)
-
-        # Create directories
-        self._exec(f"mkdir -p /apps/{service.name}")
-
-        # Upload compose file
-        self._upload_file(rendered_compose, f"/apps/{service.name}/docker-compose.yml")
+        return templating.render(template_key, compose_content, **variables), credentials
 
-        # Deploy
-        result = self._exec(f"cd /apps/{service.name} && docker compose up -d", timeout=300)
-        if result["exit_code"] != 0:
-            raise Exception(f"Deployment failed: {result['stderr']}")
+    def _service_credentials(self, service_name):
+        """Load a hosted service's credentials, generating them on first deploy
 
-        # Update Caddy
-        self._update_caddy()
+        Reusing them keeps the compose file stable across redeploys, so an
+        unchanged service is neither re-uploaded nor recreated, and its
+        database keeps the password it was initialised with.
+        """
+        stored = get_decrypted_password("Hosted Service", service_name, CREDENTIALS_FIELD, raise_exception=False)
+        if stored:
+            return json.loads(stored)
 
-        return {
-            "success": True,
-            "compose": rendered_compose,
-            "credentials": credentials
+        credentials = {
+            "db_password": secrets.token_urlsafe(16),
+            "db_root_password": secrets.token_urlsafe(16),
+            "admin_password": secrets.token_urlsafe(12),
+            "encryption_key": secrets.token_urlsafe(32),
         }
+        set_encrypted_password("Hosted Service", service_name, json.dumps(credentials), CREDENTIALS_FIELD)
+        return credentials
 
     def _get_default_compose(self, template_name):
         """Get default compose file for known templates"""
@@ -185,6 +470,8 @@ services:
     image: wordpress:6.4-php8.2-apache
     container_name: {{ SERVICE_ID }}-app
     restart: unless-stopped
+    labels:
+      appz.service: {{ SERVICE_ID }}
     environment:
       WORDPRESS_DB_HOST: db
       WORDPRESS_DB_NAME: wordpress
@@ -204,6 +491,8 @@ services:
     image: mariadb:10.11
     container_name: {{ SERVICE_ID }}-db
     restart: unless-stopped
+    labels:
+      appz.service: {{ SERVICE_ID }}
     environment:
       MYSQL_ROOT_PASSWORD: {{ DB_ROOT_PASSWORD }}
       MYSQL_DATABASE: wordpress
@@ -227,6 +516,8 @@ services:
     image: n8nio/n8n:latest
     container_name: {{ SERVICE_ID }}-app
     restart: unless-stopped
+    labels:
+      appz.service: {{ SERVICE_ID }}
     environment:
       - N8N_HOST={{ DOMAIN }}
       - N8N_PORT=5678
@@ -252,6 +543,8 @@ services:
     image: postgres:15-alpine
     container_name: {{ SERVICE_ID }}-db
     restart: unless-stopped
+    labels:
+      appz.service: {{ SERVICE_ID }}
     environment:
       POSTGRES_DB: n8n
       POSTGRES_USER: n8n
@@ -274,6 +567,8 @@ services:
     image: ghost:5-alpine
     container_name: {{ SERVICE_ID }}-app
     restart: unless-stopped
+    labels:
+      appz.service: {{ SERVICE_ID }}
     environment:
       url: https://{{ DOMAIN }}
       database__client: mysql
@@ -295,6 +590,8 @@ services:
     image: mysql:8.0
     container_name: {{ SERVICE_ID }}-db
     restart: unless-stopped
+    labels:
+      appz.service: {{ SERVICE_ID }}
     environment:
       MYSQL_ROOT_PASSWORD: {{ DB_ROOT_PASSWORD }}
       MYSQL_DATABASE: ghost
@@ -311,18 +608,42 @@ networks:
     external: true
 '''
 
-    def _update_caddy(self):
-        """Regenerate and reload Caddyfile"""
-        from appz_hosting.core.caddy import generate_caddyfile
+    def _update_caddy(self, force=False):
+        """Regenerate Caddyfile and reload Caddy, coalesced with other pending changes"""
+        from appz_hosting.core.caddy import coalesce_reload
+
+        coalesce_reload(self.server.name, lambda: self._reload_caddy(force=force))
+
+    def _reload_caddy(self, force=False):
+        """Regenerate Caddyfile and reload Caddy if it changed - caller holds the caddy lock"""
+        from appz_hosting.core.caddy import ensure_layout, sync_and_reload
+
+        return sync_and_reload(self, ensure_layout(self), force=force)
+
+    def _update_app_caddy(self):
+        """Regenerate a Customer Server's host Caddyfile, coalesced with other pending changes"""
+        from appz_hosting.core.caddy import coalesce_reload
+
+        coalesce_reload(self.server.name, self._reload_app_caddy)
 
-        caddyfile = generate_caddyfile(self.server.name)
-        self._upload_file(caddyfile, "/apps/caddy/Caddyfile")
-        self._exec("docker exec caddy caddy reload --config /etc/caddy/Caddyfile")
+    def _reload_app_caddy(self):
+        """Regenerate a Customer Server's host Caddyfile and reload if it changed"""
+        from appz_hosting.core.caddy import generate_app_caddyfile
+
+        def reload():
+            result = self._exec("systemctl reload caddy")
+            if result["exit_code"] != 0:
+                raise Exception(f"Caddy reload failed: {result['stderr']}")
+
+        caddyfile = generate_app_caddyfile(self.server.name)
+        return bool(self._sync_files({"/etc/caddy/Caddyfile": caddyfile}, apply=reload))
 
     def stop_service(self, service_name):
         """Stop a service"""
+        from appz_hosting.core.caddy import drop_service_route
+
         result = self._exec(f"cd /apps/{service_name} && docker compose down")
-        self._update_caddy()
+        drop_service_route(self, service_name)
         return result
 
     def restart_service(self, service_name):
@@ -333,13 +654,46 @@ networks:
         """Completely remove a service"""
         self._exec(f"cd /apps/{service_name} && docker compose down -v")
         self._exec(f"rm -rf /apps/{service_name}")
-        self._update_caddy()
+        self._forget_hashes(f"/apps/{service_name}/")
+
+        from appz_hosting.core.caddy import drop_service_route
+        drop_service_route(self, service_name)
 
     def get_logs(self, service_name, lines=100):
         """Get service logs"""
         result = self._exec(f"cd /apps/{service_name} && docker compose logs --tail {lines}")
         return result["stdout"]
 
+    def follow_logs(self, service_name, since=None, grep=None, tail=100, follow=True):
+        """Yield service log lines as they are produced
+
+        since is anything `docker compose logs --since` accepts (e.g. "10m" or
+        an RFC 3339 timestamp); grep filters lines on the server so only
+        matches cross the wire.
+        """
+        cmd = f"cd /apps/{shlex.quote(service_name)} && docker compose logs --no-color --tail {int(tail)}"
+        if since:
+            cmd += f" --since {shlex.quote(str(since))}"
+        if follow:
+            cmd += " --follow"
+        cmd += " 2>&1"
+        if grep:
+            cmd += f" | grep --line-buffered -e {shlex.quote(grep)}"
+
+        # A pty ties the remote process to the channel, so it dies when the
+        # consumer stops iterating instead of lingering on the server
+        pending = ""
+        for stream, data in self._exec_stream(cmd, get_pty=follow):
+            if stream == "exit":
+                break
+            pending += data
+            *lines, pending = pending.split("\n")
+            for line in lines:
+                yield line.rstrip("\r")
+
+        if pending:
+            yield pending.rstrip("\r")
+
     def get_stats(self, service_name):
         """Get resource usage for a service"""
         result = self._exec(
@@ -349,28 +703,245 @@ networks:
         return result["stdout"]
 
     def get_server_stats(self):
-        """Get overall server stats"""
-        # Memory
-        mem_result = self._exec("free -g | grep Mem | awk '{print $3}'")
-        used_ram_gb = float(mem_result["stdout"].strip() or 0)
+        """Get overall server stats in a single round trip"""
+        result = self._exec(SERVER_STATS_PROBE, timeout=30)
+        if result["exit_code"] != 0:
+            raise Exception(f"Stats probe failed: {result['stderr']}")
+        return parse_server_stats(result["stdout"], self.server.get("total_cpu_cores"))
 
-        # CPU
-        cpu_result = self._exec("top -bn1 | grep 'Cpu(s)' | awk '{print $2}'")
-        cpu_percent = float(cpu_result["stdout"].strip().replace(",", ".") or 0)
+    def close(self):
+        """Return SSH connection to the pool"""
+        self._release()
 
-        # Disk
-        disk_result = self._exec("df -BG /apps | tail -1 | awk '{print $3}'")
-        used_storage = disk_result["stdout"].strip().replace("G", "")
-        used_storage_gb = float(used_storage or 0)
+    def __enter__(self):
+        return self
 
-        return {
-            "used_ram_gb": used_ram_gb,
-            "used_cpu_cores": cpu_percent / 100 * self.server.total_cpu_cores,
-            "used_storage_gb": used_storage_gb
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __del__(self):
+        # Callers that never close() must not hold a pool slot forever
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class AppDeployment:
+    """Deploys a Deployed App as a staged pipeline
+
+    render -> upload -> pull -> up -> health -> route. Rendering happens
+    locally; the remaining stages hold one of the server's deploy slots so
+    a burst of orders doesn't start every compose project at once on a
+    small box. Each stage's timing is published as it runs and kept in
+    the app's deploy_log.
+    """
+
+    STAGES = ("render", "upload", "pull", "up", "health", "route")
+    HOST_STAGES = STAGES[1:]
+
+    def __init__(self, app):
+        self.app = app
+        self.template = frappe.get_doc("App Template", app.template)
+        self.app_dir = f"/apps/{app.name}"
+        self.files = {}
+        self.stages = []
+        self.deployer = None
+
+    def run(self):
+        """Run every stage, returning the per-stage timings"""
+        self._run_stage("render")
+
+        limit = frappe.conf.get("appz_max_deploys_per_server", MAX_DEPLOYS_PER_SERVER)
+        with server_semaphore(self.app.server, "deploy", limit=limit, wait=DEPLOY_SLOT_WAIT):
+            with Deployer(self.app.server, doctype="Customer Server") as deployer:
+                self.deployer = deployer
+                for stage in self.HOST_STAGES:
+                    self._run_stage(stage)
+
+        return {"success": True, "stages": self.stages}
+
+    def _run_stage(self, stage):
+        entry = {"stage": stage, "status": "Running"}
+        self.stages.append(entry)
+        self._publish()
+
+        started = time.monotonic()
+        try:
+            getattr(self, f"_{stage}")()
+            entry["status"] = "Done"
+        except Exception as e:
+            entry["status"] = "Failed"
+            entry["error"] = str(e)
+            raise
+        finally:
+            entry["duration"] = round(time.monotonic() - started, 3)
+            self._publish()
+
+    def _publish(self):
+        """Persist and broadcast stage progress"""
+        self.app.deploy_log = json.dumps(self.stages, indent=1)
+        frappe.db.set_value("Deployed App", self.app.name, "deploy_log", self.app.deploy_log,
+                            update_modified=False)
+
+        done = sum(1 for s in self.stages if s["status"] == "Done")
+        frappe.publish_realtime(
+            "appz_deploy_progress",
+            {
+                "app": self.app.name,
+                "stages": self.stages,
+                "progress": round(done / len(self.STAGES) * 100),
+            },
+            doctype="Deployed App",
+            docname=self.app.name,
+        )
+
+    def _render(self):
+        if not self.template.docker_compose:
+            raise Exception(f"App Template {self.template.name} has no docker compose")
+
+        port = self._allocate_port()
+        env = self._get_env()
+        variables = {
+            **{key.lower(): value for key, value in env.items()},
+            "container_name": self.app.container_name,
+            "domain": self.app.domain,
+            "port": port,
+            "ssh_port": port + 1,
+            "db_name": self.template.template_name,
+            "db_user": self.template.template_name,
+            "site_title": self.app.app_name,
         }
 
-    def close(self):
-        """Close SSH connection"""
-        if self.ssh:
-            self.ssh.close()
-            self.ssh = None
+        self.files[f"{self.app_dir}/docker-compose.yml"] = self.template.render_compose(variables)
+        env_lines = [f"{key}={value}" for key, value in env.items()]
+        rendered_env = self.template.render_env(variables)
+        if rendered_env:
+            env_lines.append(rendered_env)
+        self.files[f"{self.app_dir}/.env"] = "\n".join(env_lines) + "\n"
+        if self.app.docker_compose_override:
+            self.files[f"{self.app_dir}/docker-compose.override.yml"] = self.app.docker_compose_override
+
+    def _allocate_port(self):
+        """Reserve a block of host ports for the app on its server"""
+        if self.app.internal_port:
+            return self.app.internal_port
+
+        with server_semaphore(self.app.server, "ports", wait=30):
+            ports = frappe.get_all("Deployed App", filters={"server": self.app.server}, pluck="internal_port")
+            port = max([p for p in ports if p] or [APP_PORT_BASE - APP_PORT_STEP]) + APP_PORT_STEP
+            frappe.db.set_value("Deployed App", self.app.name, "internal_port", port, update_modified=False)
+            frappe.db.commit()
+
+        self.app.internal_port = port
+        return port
+
+    def _get_env(self):
+        """Load the app's env variables, generating credentials on first deploy"""
+        env = {}
+        for line in (self.app.env_variables or "").splitlines():
+            key, sep, value = line.partition("=")
+            if sep and key.strip() and not key.strip().startswith("#"):
+                env[key.strip()] = value.strip()
+
+        generated = False
+        for key, length in (("DB_PASSWORD", 16), ("DB_ROOT_PASSWORD", 16), ("ADMIN_PASSWORD", 12)):
+            if not env.get(key):
+                env[key] = secrets.token_urlsafe(length)
+                generated = True
+
+        if generated:
+            self.app.env_variables = "\n".join(f"{key}={value}" for key, value in env.items())
+            frappe.db.set_value("Deployed App", self.app.name, "env_variables", self.app.env_variables,
+                                update_modified=False)
+        return env
+
+    def _upload(self):
+        self.deployer._sync_files(self.files)
+
+    def _pull(self):
+        images.ensure_images(self.deployer, self.files[f"{self.app_dir}/docker-compose.yml"])
+
+    def _up(self):
+        result = self.deployer._exec(f"cd {self.app_dir} && docker compose up -d", timeout=300)
+        if result["exit_code"] != 0:
+            raise Exception(f"docker compose up failed: {result['stderr']}")
+
+    def _health(self):
+        """Wait until the app answers on its published port"""
+        path = self.template.healthcheck_path
+        if path:
+            url = shlex.quote(f"http://127.0.0.1:{self.app.internal_port}{path}")
+            probe = f'code=$(curl -s -o /dev/null -w "%{{http_code}}" {url}); [ "$code" -ge 200 ] && [ "$code" -lt 500 ]'
+        else:
+            container = shlex.quote(self.app.container_name)
+            probe = f'[ "$(docker inspect -f "{{{{.State.Running}}}}" {container} 2>/dev/null)" = "true" ]'
+
+        tries = HEALTH_TIMEOUT // 2
+        result = self.deployer._exec(
+            f"for i in $(seq 1 {tries}); do if {probe}; then exit 0; fi; sleep 2; done; exit 1",
+            timeout=HEALTH_TIMEOUT + 30,
+        )
+        if result["exit_code"] != 0:
+            raise Exception(f"App did not become healthy within {HEALTH_TIMEOUT}s")
+
+    def _route(self):
+        if self.app.domain:
+            self.deployer._update_app_caddy()
+
+
+def deploy_app(app):
+    """Deploy a Deployed App to its Customer Server"""
+    try:
+        return AppDeployment(app).run()
+    except Exception as e:
+        frappe.log_error(f"Deployment failed for {app.name}: {e}", "App Deployment")
+        return {"success": False, "error": str(e)}
+
+
+def deploy_app_async(app_name):
+    """Background job enqueued when a Deployed App is created"""
+    app = frappe.get_doc("Deployed App", app_name)
+    app.deploy()
+    frappe.db.commit()
+
+
+def _app_compose(app, args, timeout=120):
+    with Deployer(app.server, doctype="Customer Server") as deployer:
+        result = deployer._exec(f"cd /apps/{app.name} && docker compose {args}", timeout=timeout)
+    result["success"] = result["exit_code"] == 0
+    return result
+
+
+def stop_app(app):
+    """Stop a Deployed App's containers"""
+    return _app_compose(app, "stop")
+
+
+def start_app(app):
+    """Start a Deployed App's containers"""
+    return _app_compose(app, "up -d", timeout=300)
+
+
+def remove_app(app):
+    """Remove a Deployed App's containers, data and route"""
+    with Deployer(app.server, doctype="Customer Server") as deployer:
+        result = deployer._exec(f"cd /apps/{app.name} && docker compose down -v", timeout=300)
+        deployer._exec(f"rm -rf /apps/{app.name}")
+        deployer._forget_hashes(f"/apps/{app.name}/")
+
+        # Drop the route before the caller records the removal
+        if result["exit_code"] == 0:
+            frappe.db.set_value("Deployed App", app.name, "status", "Removed", update_modified=False)
+            if app.status != "Removed":
+                # set_value skips doc events, so adjust the app count here
+                capacity.adjust_apps_count(app.server, -1)
+            deployer._update_app_caddy()
+
+    result["success"] = result["exit_code"] == 0
+    return result
+
+
+def get_app_logs(app, lines=100):
+    """Get a Deployed App's recent logs"""
+    return _app_compose(app, f"logs --no-color --tail {int(lines)}")["stdout"]
@@ -35,13 +35,27 @@ def on_app_created(doc, method):
     """Handle new app deployment"""
     frappe.logger().info(f"Deploying app: {doc.app_name} on {doc.server}")
 
-    # Enqueue deployment
+    from appz_hosting.core.deployer import DEPLOY_JOB_TIMEOUT
+
+    # Enqueue deployment (the server's app count is bumped by core.capacity).
+    # A cold first deploy can outlast the default queue's 300s timeout.
     frappe.enqueue(
         "appz_hosting.core.deployer.deploy_app_async",
+        queue="long",
+        timeout=DEPLOY_JOB_TIMEOUT,
         app_name=doc.name,
     )
 
-    # Update server apps count
-    server = frappe.get_doc("Customer Server", doc.server)
-    server.update_apps_count()
-    server.save(ignore_permissions=True)
+
+def on_template_updated(doc, method):
+    """Re-warm server image caches when a template's images change"""
+    if not doc.enabled:
+        return
+    if not (doc.has_value_changed("docker_compose") or doc.has_value_changed("enabled")):
+        return
+
+    frappe.enqueue(
+        "appz_hosting.core.images.warm_all_servers",
+        queue="long",
+        template_names=[doc.name],
+    )
@@ -0,0 +1,135 @@
+"""
+Fleet Executor for AppZ Hosting
+
+Runs commands and small scripts on many servers concurrently with asyncssh.
+"""
+
+import asyncio
+import os
+import time
+
+import asyncssh
+import frappe
+
+
+DEFAULT_CONCURRENCY = 50
+DEFAULT_TIMEOUT = 60  # seconds per host
+DEFAULT_CONNECT_TIMEOUT = 15  # seconds
+
+# Field holding the SSH key path on each server doctype
+SSH_KEY_FIELDS = {
+    "AppZ Server": "ssh_key",
+    "Customer Server": "ssh_key_path",
+}
+
+_keys = {}  # key_path -> (mtime, SSHKey)
+
+
+def load_private_key(key_path=None):
+    """Load a private key once per worker, reloading only if the file changes"""
+    key_path = key_path or os.path.expanduser("~/.ssh/id_rsa")
+    mtime = os.path.getmtime(key_path)
+
+    cached = _keys.get(key_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    key = asyncssh.read_private_key(key_path)
+    _keys[key_path] = (mtime, key)
+    return key
+
+
+async def connect(host, key_path=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+    """Open an asyncssh connection to a server as root"""
+    return await asyncssh.connect(
+        host,
+        username="root",
+        client_keys=[load_private_key(key_path)],
+        known_hosts=None,
+        connect_timeout=connect_timeout,
+        keepalive_interval=30,
+    )
+
+
+def get_fleet_targets(doctypes=("AppZ Server", "Customer Server"), names=None):
+    """Get connection targets for all active servers of the given doctypes"""
+    targets = []
+    for doctype in doctypes:
+        filters = {"status": "Active", "ip_address": ["is", "set"]}
+        if names:
+            filters["name"] = ["in", names]
+
+        key_field = SSH_KEY_FIELDS[doctype]
+        for server in frappe.get_all(doctype, filters=filters, fields=["name", "ip_address", key_field]):
+            targets.append({
+                "server": server.name,
+                "doctype": doctype,
+                "host": server.ip_address,
+                "ssh_key": server.get(key_field),
+            })
+    return targets
+
+
+class FleetExecutor:
+    """Runs a command on many servers at once with bounded concurrency"""
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+
+    async def run(self, targets, command, script=None):
+        """Run command (fed script on stdin, if given) on every target"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(target):
+            async with semaphore:
+                return await self._run_one(target, command, script)
+
+        return await asyncio.gather(*(bounded(t) for t in targets))
+
+    async def run_script(self, targets, script):
+        """Run a shell script on every target"""
+        return await self.run(targets, "bash -s", script=script)
+
+    async def _run_one(self, target, command, script):
+        result = {
+            "server": target["server"],
+            "host": target["host"],
+            "success": False,
+            "exit_code": None,
+            "stdout": "",
+            "stderr": "",
+            "error": None,
+        }
+        started = time.monotonic()
+
+        async def run_command():
+            async with await connect(target["host"], target.get("ssh_key"), self.connect_timeout) as conn:
+                return await conn.run(command, input=script, check=False)
+
+        try:
+            proc = await asyncio.wait_for(run_command(), self.timeout)
+            result.update({
+                "success": proc.exit_status == 0,
+                "exit_code": proc.exit_status,
+                "stdout": proc.stdout,
+                "stderr": proc.stderr,
+            })
+        except asyncio.TimeoutError:
+            result["error"] = f"Timed out after {self.timeout}s"
+        except Exception as e:
+            # Anything one host raises (bad key file, refused connection...)
+            # belongs in that host's result, not to the whole sweep
+            result["error"] = str(e) or type(e).__name__
+
+        result["duration"] = round(time.monotonic() - started, 3)
+        return result
+
+
+def run_on_fleet(command, targets=None, script=None, **kwargs):
+    """Run a command across the fleet from synchronous code (e.g. scheduler jobs)"""
+    if targets is None:
+        targets = get_fleet_targets()
+    return asyncio.run(FleetExecutor(**kwargs).run(targets, command, script=script))
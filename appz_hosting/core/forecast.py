@@ -0,0 +1,263 @@
+"""
+Capacity Forecasting for AppZ Hosting
+
+Backs the Capacity Advisor: fits a robust trend plus daily and weekly
+seasonality to every server's hourly RAM, CPU and disk history, predicts
+when each server crosses its thresholds and recommends the Server Plan to
+move to. The whole fleet is fitted in one batched NumPy pass.
+"""
+
+import time
+import warnings
+
+import frappe
+import numpy as np
+
+from appz_hosting.core.metrics import SERVER_METRICS, load_series, series_key
+from appz_hosting.core.placement import (
+    DEFAULT_MAX_CPU_PERCENT,
+    DEFAULT_MAX_RAM_PERCENT,
+    STORAGE_CEILING,
+)
+
+
+HISTORY_DAYS = 28  # hourly history each fit uses
+MIN_POINTS = 72  # hours of history needed before forecasting a series
+WEEKLY_MIN_POINTS = 336  # hours of history needed before fitting weekly seasonality
+HORIZON_DAYS = 90  # how far ahead crossings are reported and plans sized
+UPGRADE_WITHIN_DAYS = 30  # recommend a plan when a threshold is this close
+HUBER_K = 1.345
+ROBUST_ITERATIONS = 3
+DAILY_HARMONICS = 3
+WEEKLY_HARMONICS = 2
+
+FORECAST_CACHE_KEY = "appz_capacity_forecast"
+HOURS_PER_DAY = 24
+HOURS_PER_WEEK = 168
+
+
+def design_matrix(hours, weekly=True):
+    """Intercept, trend (per day) and Fourier seasonality terms for hour indices
+
+    Without weekly, the weekly columns are left out; they always come last.
+    """
+    hours = np.asarray(hours, dtype=float)
+    columns = [np.ones_like(hours), hours / HOURS_PER_DAY]
+    seasons = [(HOURS_PER_DAY, DAILY_HARMONICS)]
+    if weekly:
+        seasons.append((HOURS_PER_WEEK, WEEKLY_HARMONICS))
+    for period, harmonics in seasons:
+        for k in range(1, harmonics + 1):
+            angle = 2 * np.pi * k * hours / period
+            columns += [np.sin(angle), np.cos(angle)]
+    return np.column_stack(columns)
+
+
+def fit(values, hours):
+    """Fit every row of values (series x hours, NaN for gaps) at once
+
+    Least squares with Huber reweighting, so a one-off spike or outage
+    doesn't bend the trend. Weekly terms are only fitted for series with
+    WEEKLY_MIN_POINTS of history - with less than two weeks they can't be
+    told apart from the trend; the other series get zero weekly terms.
+    Returns (coefficients, valid rows mask).
+    """
+    points = (~np.isnan(values)).sum(axis=1)
+    weekly = points >= WEEKLY_MIN_POINTS
+    coefficients = np.zeros((len(values), design_matrix(hours).shape[1]))
+    for rows, with_weekly in ((weekly, True), (~weekly, False)):
+        if rows.any():
+            fitted = _fit_rows(values[rows], design_matrix(hours, weekly=with_weekly))
+            coefficients[np.ix_(rows, np.arange(fitted.shape[1]))] = fitted
+    return coefficients, points >= MIN_POINTS
+
+
+def _fit_rows(values, X):
+    """Huber-reweighted least squares of every row of values on the columns of X"""
+    observed = ~np.isnan(values)
+    y = np.where(observed, values, 0.0)
+    weights = observed.astype(float)
+    p = X.shape[1]
+    # Outer products of the design rows, so every series' normal equations
+    # come out of one matrix multiply
+    outer = (X[:, :, None] * X[:, None, :]).reshape(len(X), p * p)
+    ridge = np.eye(p) * 1e-6
+
+    for _ in range(ROBUST_ITERATIONS + 1):
+        xtwx = (weights @ outer).reshape(-1, p, p) + ridge
+        xtwy = (weights * y) @ X
+        coefficients = np.linalg.solve(xtwx, xtwy[..., None])[..., 0]
+
+        residuals = np.where(observed, y - coefficients @ X.T, np.nan)
+        with np.errstate(all="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # series with no history
+            scale = 1.4826 * np.nanmedian(np.abs(residuals), axis=1, keepdims=True)
+            huber = np.minimum(1.0, HUBER_K * scale / np.abs(residuals))
+        weights = np.where(observed, np.nan_to_num(huber, nan=1.0, posinf=1.0), 0.0)
+
+    return coefficients
+
+
+def seasonal_peak(coefficients):
+    """Highest seasonal lift of each fitted series over a week"""
+    week = design_matrix(np.arange(HOURS_PER_WEEK))
+    return (coefficients[:, 2:] @ week[:, 2:].T).max(axis=1)
+
+
+def days_to_cross(coefficients, limits):
+    """Days until each series' seasonal peak reaches its limit (0 if already, inf if never)"""
+    level, slope = coefficients[:, 0], coefficients[:, 1]
+    peak_now = level + seasonal_peak(coefficients)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days = np.where(slope > 0, (limits - peak_now) / slope, np.inf)
+    return np.where(peak_now >= limits, 0.0, np.maximum(days, 0.0))
+
+
+def history_matrix(series, metric, end_hour, hours):
+    """Hourly values of one metric for each series, aligned on the same hour grid"""
+    index = np.arange(end_hour - hours + 1, end_hour + 1)
+    matrix = np.full((len(series), hours), np.nan)
+    for row, s in enumerate(series):
+        if s is None or metric not in s.metrics:
+            continue
+        ring = s.rings["hourly"]
+        column = np.frombuffer(ring.values[s.metrics.index(metric)], dtype=np.float32)
+        covered = (index <= ring.last_index) & (index > ring.last_index - ring.slots)
+        matrix[row, covered] = column[index[covered] % ring.slots]
+    return matrix, index - end_hour
+
+
+def get_servers():
+    """Active servers with their capacity totals and threshold fractions"""
+    servers = []
+    for server in frappe.get_all(
+        "AppZ Server",
+        filters={"status": "Active"},
+        fields=["name", "total_ram_gb", "total_cpu_cores", "total_storage_gb",
+                "max_ram_percent", "max_cpu_percent"],
+    ):
+        servers.append({
+            "doctype": "AppZ Server",
+            "name": server.name,
+            "plan": None,
+            "totals": (server.total_ram_gb, server.total_cpu_cores, server.total_storage_gb),
+            "thresholds": ((server.max_ram_percent or DEFAULT_MAX_RAM_PERCENT) / 100,
+                           (server.max_cpu_percent or DEFAULT_MAX_CPU_PERCENT) / 100,
+                           STORAGE_CEILING),
+        })
+
+    plans = {p.name: p for p in frappe.get_all("Server Plan", fields=["name", "ram_gb", "cpu_cores", "storage_gb"])}
+    for server in frappe.get_all("Customer Server", filters={"status": "Active"}, fields=["name", "plan"]):
+        plan = plans.get(server.plan)
+        servers.append({
+            "doctype": "Customer Server",
+            "name": server.name,
+            "plan": server.plan,
+            "totals": (plan.ram_gb, plan.cpu_cores, plan.storage_gb) if plan else (0, 0, 0),
+            "thresholds": (DEFAULT_MAX_RAM_PERCENT / 100, DEFAULT_MAX_CPU_PERCENT / 100, STORAGE_CEILING),
+        })
+    return servers
+
+
+def recommend_plans(needs, current_plans):
+    """Cheapest enabled Server Plan covering each row of needs (RAM GB, cores, GB), or None"""
+    plans = frappe.get_all(
+        "Server Plan",
+        filters={"enabled": 1},
+        fields=["name", "ram_gb", "cpu_cores", "storage_gb", "price_usd"],
+        order_by="price_usd asc",
+    )
+    if not plans:
+        return [None] * len(needs)
+
+    specs = np.array([(p.ram_gb or 0, p.cpu_cores or 0, p.storage_gb or 0) for p in plans], dtype=float)
+    fits = np.all(specs[None, :, :] >= needs[:, None, :], axis=2)  # servers x plans
+    # Plans are sorted by price, so the first fitting one is the cheapest
+    first = np.where(fits.any(axis=1), fits.argmax(axis=1), -1)
+    return [
+        plans[i].name if i >= 0 and plans[i].name != current else None
+        for i, current in zip(first, current_plans)
+    ]
+
+
+def forecast_fleet(now=None):
+    """Daily: forecast threshold crossings for every active server in one batched pass"""
+    started = time.monotonic()
+    servers = get_servers()
+    if not servers:
+        return {}
+
+    stored = load_series([series_key(s["doctype"], s["name"]) for s in servers])
+    series = [stored.get(series_key(s["doctype"], s["name"])) for s in servers]
+    end_hour = int(now or time.time()) // 3600 - 1  # last completed hour
+
+    # One row per (server, metric), fitted together
+    history, hours = zip(*(
+        history_matrix(series, metric, end_hour, HISTORY_DAYS * HOURS_PER_DAY) for metric in SERVER_METRICS
+    ))
+    values = np.concatenate(history)
+    coefficients, valid = fit(values, hours[0])
+
+    totals = np.array([s["totals"] for s in servers], dtype=float)  # servers x metrics
+    thresholds = np.array([s["thresholds"] for s in servers], dtype=float)
+    limits = (np.nan_to_num(totals) * thresholds).T.reshape(-1)  # metric-major, like values
+
+    days = days_to_cross(coefficients, limits)
+    days = np.where(valid & (limits > 0), days, np.nan).reshape(len(SERVER_METRICS), len(servers)).T
+    level = coefficients[:, 0].reshape(len(SERVER_METRICS), len(servers)).T
+    slope = coefficients[:, 1].reshape(len(SERVER_METRICS), len(servers)).T
+    peak = seasonal_peak(coefficients).reshape(len(SERVER_METRICS), len(servers)).T
+    history_hours = (~np.isnan(values)).sum(axis=1).reshape(len(SERVER_METRICS), len(servers)).T
+
+    # Size plans for the peak expected at the horizon, kept under the thresholds
+    projected = level + np.maximum(slope, 0) * HORIZON_DAYS + peak
+    needs = np.where(np.isnan(days), 0, projected / thresholds)
+    due = np.nanmin(np.where(np.isnan(days), np.inf, days), axis=1) <= UPGRADE_WITHIN_DAYS
+    recommended = recommend_plans(needs, [s["plan"] for s in servers])
+
+    forecasts = {}
+    for i, server in enumerate(servers):
+        metrics = {}
+        for j, metric in enumerate(SERVER_METRICS):
+            metrics[metric] = {
+                "current": None if np.isnan(days[i, j]) else round(float(level[i, j]), 2),
+                "trend_per_day": None if np.isnan(days[i, j]) else round(float(slope[i, j]), 4),
+                "limit": round(float(totals[i, j] * thresholds[i, j]), 2),
+                "days_to_threshold": _days(days[i, j]),
+                "history_hours": int(history_hours[i, j]),
+            }
+        crossing = [m["days_to_threshold"] for m in metrics.values() if m["days_to_threshold"] is not None]
+        forecasts[series_key(server["doctype"], server["name"])] = {
+            "server": server["name"],
+            "doctype": server["doctype"],
+            "metrics": metrics,
+            "days_to_threshold": min(crossing) if crossing else None,
+            "recommended_plan": recommended[i] if due[i] else None,
+            # Metrics with less than MIN_POINTS hours are left out, not forecast
+            "insufficient_history": bool((history_hours[i] < MIN_POINTS).any()),
+        }
+
+    frappe.cache().set_value(FORECAST_CACHE_KEY, forecasts)
+    frappe.logger("appz_monitoring").info(
+        f"Capacity forecast: {len(servers)} servers in {round(time.monotonic() - started, 2)}s"
+    )
+    return forecasts
+
+
+def _days(value):
+    if np.isnan(value) or value > HORIZON_DAYS:
+        return None
+    return round(float(value), 1)
+
+
+@frappe.whitelist()
+def get_capacity_forecast(server_name=None, doctype="AppZ Server"):
+    """Latest daily forecast for one server, or for the whole fleet"""
+    frappe.only_for("System Manager")
+    forecasts = frappe.cache().get_value(FORECAST_CACHE_KEY) or {}
+    if server_name:
+        return forecasts.get(series_key(doctype, server_name))
+    return sorted(
+        forecasts.values(),
+        key=lambda f: f["days_to_threshold"] if f["days_to_threshold"] is not None else float("inf"),
+    )
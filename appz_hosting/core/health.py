@@ -0,0 +1,77 @@
+"""
+Site Health Checks for AppZ Hosting
+
+Checks many sites concurrently over a shared httpx connection pool.
+"""
+
+import asyncio
+import time
+
+import frappe
+import httpx
+
+
+DEFAULT_CONCURRENCY = 100
+CONNECT_TIMEOUT = 5  # seconds
+READ_TIMEOUT = 10  # seconds
+
+# Servers that don't implement HEAD properly answer with one of these
+HEAD_UNSUPPORTED = {405, 501}
+
+
+def get_healthcheck_paths():
+    """Map App Template name -> healthcheck path"""
+    return {
+        t.name: t.healthcheck_path or "/"
+        for t in frappe.get_all("App Template", fields=["name", "healthcheck_path"])
+    }
+
+
+def site_url(domain, path="/"):
+    if not path.startswith("/"):
+        path = "/" + path
+    return f"https://{domain}{path}"
+
+
+async def _check(client, semaphore, target):
+    result = {
+        "name": target["name"],
+        "url": target["url"],
+        "healthy": False,
+        "status_code": None,
+        "error": None,
+    }
+    started = time.monotonic()
+
+    async with semaphore:
+        try:
+            response = await client.head(target["url"])
+            if response.status_code in HEAD_UNSUPPORTED:
+                response = await client.get(target["url"])
+            result["status_code"] = response.status_code
+            result["healthy"] = response.status_code < 400
+        except httpx.HTTPError as e:
+            result["error"] = f"{type(e).__name__}: {e}"[:140]
+
+    result["elapsed"] = round(time.monotonic() - started, 3)
+    return result
+
+
+async def check_targets(targets, concurrency=DEFAULT_CONCURRENCY,
+                        connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+    """Check [{"name", "url"}] targets concurrently, one result dict per target"""
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        follow_redirects=True,
+        headers={"User-Agent": "AppZ-Health-Check/1.0"},
+    ) as client:
+        return await asyncio.gather(*(_check(client, semaphore, t) for t in targets))
+
+
+def run_health_checks(targets, **kwargs):
+    """Check targets from synchronous code"""
+    if not targets:
+        return []
+    return asyncio.run(check_targets(targets, **kwargs))
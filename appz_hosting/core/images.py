@@ -0,0 +1,117 @@
+"""
+Image Cache for AppZ Hosting
+
+Pre-pulls the images used by App Templates onto servers and tracks which
+image digests each server already has, so deployments don't wait on pulls.
+"""
+
+import re
+import shlex
+
+import frappe
+
+from appz_hosting.core.fleet import get_fleet_targets, run_on_fleet
+
+
+IMAGE_LINE = re.compile(r"^\s*image:\s*[\"']?([^\"'\s#]+)", re.MULTILINE)
+PULL_TIMEOUT = 900  # seconds per server
+WARM_JOB_TIMEOUT = PULL_TIMEOUT + 300  # one server's pre-pull job, with connecting and recording
+
+
+def extract_images(compose_content):
+    """Get the image references from a compose file"""
+    if not compose_content:
+        return []
+    # Skip templated references - they can only be resolved at deploy time
+    return sorted({m for m in IMAGE_LINE.findall(compose_content) if "{{" not in m})
+
+
+def get_template_images(template_names=None):
+    """Get the images used by enabled App Templates"""
+    filters = {"enabled": 1}
+    if template_names:
+        filters["name"] = ["in", template_names]
+
+    images = set()
+    for compose in frappe.get_all("App Template", filters=filters, pluck="docker_compose"):
+        images.update(extract_images(compose))
+    return sorted(images)
+
+
+def pull_script(images, only_missing=False):
+    """Shell script that pulls images and prints '<image> <digest>' per success"""
+    lines = []
+    for image in images:
+        quoted = shlex.quote(image)
+        pull = f"docker pull -q {quoted} >/dev/null 2>&1"
+        if only_missing:
+            pull = f"{{ docker image inspect {quoted} >/dev/null 2>&1 || {pull}; }}"
+        lines.append(
+            f"{pull} && echo {quoted} "
+            f"$(docker image inspect --format '{{{{.Id}}}}' {quoted})"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def _cache_key(server_name):
+    return f"appz_image_digests|{server_name}"
+
+
+def get_cached_digests(server_name):
+    """Get {image: digest} for images known to be on a server"""
+    digests = frappe.cache().hgetall(_cache_key(server_name)) or {}
+    return {frappe.safe_decode(k): frappe.safe_decode(v) for k, v in digests.items()}
+
+
+def record_digests(server_name, output):
+    """Store the '<image> <digest>' lines printed by pull_script"""
+    recorded = {}
+    for line in output.splitlines():
+        image, _, digest = line.strip().partition(" ")
+        if image and digest:
+            frappe.cache().hset(_cache_key(server_name), image, digest)
+            recorded[image] = digest
+    return recorded
+
+
+def ensure_images(deployer, compose_content):
+    """Pull the images of a compose file that the server isn't known to have"""
+    images = extract_images(compose_content)
+    cached = get_cached_digests(deployer.server.name)
+    missing = [image for image in images if image not in cached]
+    if not missing:
+        return {}
+
+    result = deployer._exec(pull_script(missing, only_missing=True), timeout=PULL_TIMEOUT)
+    return record_digests(deployer.server.name, result["stdout"])
+
+
+def warm_server_images(server_name, doctype="AppZ Server", template_names=None):
+    """Pre-pull template images on one server (enqueued after bootstrap)"""
+    from appz_hosting.core.deployer import Deployer
+
+    images = get_template_images(template_names)
+    if not images:
+        return {}
+
+    with Deployer(server_name, doctype=doctype) as deployer:
+        result = deployer._exec(pull_script(images), timeout=PULL_TIMEOUT)
+    return record_digests(server_name, result["stdout"])
+
+
+def warm_all_servers(template_names=None):
+    """Pre-pull template images on every active server concurrently"""
+    images = get_template_images(template_names)
+    if not images:
+        return
+
+    results = run_on_fleet("bash -s", targets=get_fleet_targets(), script=pull_script(images),
+                           timeout=PULL_TIMEOUT)
+    for result in results:
+        if result["stdout"]:
+            record_digests(result["server"], result["stdout"])
+        if not result["success"]:
+            frappe.log_error(
+                f"Image pre-pull failed on {result['server']}: {result['error'] or result['stderr']}",
+                "Image Pre-pull",
+            )
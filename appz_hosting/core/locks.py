@@ -0,0 +1,57 @@
+"""
+Cross-worker locks for AppZ Hosting
+
+Redis-backed counting semaphores, so limits such as "two deployments per
+server" hold across every worker process, not just within one.
+"""
+
+import time
+from contextlib import contextmanager
+
+import frappe
+
+
+DEFAULT_WAIT = 600  # seconds to wait for a free slot
+DEFAULT_TTL = 1800  # seconds before a crashed holder's slot frees itself
+
+# Delete the slot only if we still own it
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def try_acquire(server_name, scope, limit=1, ttl=DEFAULT_TTL):
+    """Take a free (scope, server) slot without waiting; returns a handle or None"""
+    cache = frappe.cache()
+    token = frappe.generate_hash(length=16)
+    for i in range(limit):
+        key = cache.make_key(f"appz_lock|{scope}|{server_name}|{i}")
+        if cache.set(key, token, nx=True, ex=ttl):
+            return key, token
+    return None
+
+
+def release(handle):
+    """Give back a slot returned by try_acquire"""
+    key, token = handle
+    frappe.cache().eval(_RELEASE_SCRIPT, 1, key, token)
+
+
+@contextmanager
+def server_semaphore(server_name, scope, limit=1, wait=DEFAULT_WAIT, ttl=DEFAULT_TTL):
+    """Hold one of `limit` slots for (scope, server) across all workers"""
+    deadline = time.monotonic() + wait
+    handle = try_acquire(server_name, scope, limit, ttl)
+    while handle is None:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Timed out waiting for {scope} slot on {server_name}")
+        time.sleep(0.5)
+        handle = try_acquire(server_name, scope, limit, ttl)
+
+    try:
+        yield
+    finally:
+        release(handle)
@@ -0,0 +1,231 @@
+"""
+Metrics Store for AppZ Hosting
+
+Keeps usage history for servers and containers as fixed-width ring buffers:
+raw 5-minute samples, hourly means and daily means. Each series is stored as
+one compressed binary blob in Metric Series, and a sweep writes every series
+it touched in a single upsert.
+"""
+
+import base64
+import math
+import struct
+import time
+import zlib
+from array import array
+
+import frappe
+
+
+# (name, step seconds, slots): 2 days raw, 60 days hourly, 2 years daily
+RESOLUTIONS = (
+    ("raw", 300, 576),
+    ("hourly", 3600, 1440),
+    ("daily", 86400, 730),
+)
+
+SERVER_METRICS = ("ram_gb", "cpu_cores", "storage_gb")
+CONTAINER_METRICS = ("ram_mb", "cpu_percent", "storage_gb")
+
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<BB")  # version, metric count
+_RING_HEADER = struct.Struct("<IIq")  # step, slots, last slot index
+
+NAN = float("nan")
+
+
+class RingBuffer:
+    """Fixed-size ring of float32 samples for several metrics at one resolution
+
+    Timestamps are implicit: slot i holds the sample for time bucket
+    (bucket % slots == i), so each sample costs 4 bytes per metric.
+    """
+
+    def __init__(self, step, slots, metric_count, last_index=-1, values=None):
+        self.step = step
+        self.slots = slots
+        self.metric_count = metric_count
+        self.last_index = last_index
+        self.values = values or [array("f", [NAN]) * slots for _ in range(metric_count)]
+
+    def put(self, ts, sample):
+        """Store sample (one value per metric) for the bucket containing ts"""
+        index = int(ts) // self.step
+        if index <= self.last_index - self.slots:
+            return  # older than the ring covers
+
+        # Clear slots for buckets skipped since the last sample
+        if self.last_index >= 0 and index > self.last_index + 1:
+            for skipped in range(self.last_index + 1, min(index, self.last_index + 1 + self.slots)):
+                for column in self.values:
+                    column[skipped % self.slots] = NAN
+
+        for column, value in zip(self.values, sample):
+            column[index % self.slots] = NAN if value is None else value
+        self.last_index = max(self.last_index, index)
+
+    def mean(self, start, end):
+        """Per-metric mean of the samples in [start, end), None where empty"""
+        means = []
+        for column in self.values:
+            points = [v for _, v in self._iter(column, start, end) if not math.isnan(v)]
+            means.append(sum(points) / len(points) if points else None)
+        return means
+
+    def range(self, metric_index, start, end):
+        """[(ts, value)] for one metric in [start, end), skipping gaps"""
+        return [(ts, v) for ts, v in self._iter(self.values[metric_index], start, end) if not math.isnan(v)]
+
+    def covers(self, start):
+        return self.last_index >= 0 and start // self.step > self.last_index - self.slots
+
+    def _iter(self, column, start, end):
+        first = max(int(start) // self.step, self.last_index - self.slots + 1)
+        last = min((int(end) - 1) // self.step, self.last_index)
+        for index in range(first, last + 1):
+            yield index * self.step, column[index % self.slots]
+
+    def to_bytes(self):
+        return _RING_HEADER.pack(self.step, self.slots, self.last_index) + b"".join(
+            column.tobytes() for column in self.values
+        )
+
+    @classmethod
+    def from_bytes(cls, data, offset, metric_count):
+        step, slots, last_index = _RING_HEADER.unpack_from(data, offset)
+        offset += _RING_HEADER.size
+        values = []
+        for _ in range(metric_count):
+            column = array("f")
+            column.frombytes(data[offset:offset + slots * column.itemsize])
+            offset += slots * column.itemsize
+            values.append(column)
+        return cls(step, slots, metric_count, last_index, values), offset
+
+
+class MetricSeries:
+    """Raw, hourly and daily rings for one server or container"""
+
+    def __init__(self, metrics, rings=None):
+        self.metrics = tuple(metrics)
+        self.rings = rings or {
+            name: RingBuffer(step, slots, len(self.metrics)) for name, step, slots in RESOLUTIONS
+        }
+
+    def add(self, ts, sample):
+        """Record a raw sample, rolling finished hours and days into the coarser rings"""
+        raw, hourly, daily = self.rings["raw"], self.rings["hourly"], self.rings["daily"]
+        previous = raw.last_index * raw.step if raw.last_index >= 0 else None
+        raw.put(ts, [sample.get(m) for m in self.metrics])
+
+        if previous is None:
+            return
+        for source, target in ((raw, hourly), (hourly, daily)):
+            bucket = previous // target.step * target.step
+            if int(ts) // target.step * target.step > bucket:
+                target.put(bucket, source.mean(bucket, bucket + target.step))
+
+    def query(self, metric, start, end=None):
+        """[(ts, value)] for metric, from the finest ring that still covers start"""
+        end = end or time.time()
+        index = self.metrics.index(metric)
+        for name, _, _ in RESOLUTIONS:
+            ring = self.rings[name]
+            if ring.covers(start):
+                return ring.range(index, start, end)
+        return self.rings["daily"].range(index, start, end)
+
+    def to_blob(self):
+        names = ",".join(self.metrics).encode()
+        data = _HEADER.pack(FORMAT_VERSION, len(self.metrics)) + struct.pack("<H", len(names)) + names
+        data += b"".join(self.rings[name].to_bytes() for name, _, _ in RESOLUTIONS)
+        return base64.b64encode(zlib.compress(data)).decode()
+
+    @classmethod
+    def from_blob(cls, blob):
+        data = zlib.decompress(base64.b64decode(blob))
+        version, metric_count = _HEADER.unpack_from(data, 0)
+        offset = _HEADER.size
+        (names_len,) = struct.unpack_from("<H", data, offset)
+        offset += 2
+        metrics = data[offset:offset + names_len].decode().split(",")
+        offset += names_len
+
+        rings = {}
+        for name, _, _ in RESOLUTIONS:
+            rings[name], offset = RingBuffer.from_bytes(data, offset, metric_count)
+        return cls(metrics, rings)
+
+
+def server_sample(stats):
+    """Server metrics sample from parse_server_stats output"""
+    return {
+        "ram_gb": stats["used_ram_gb"],
+        "cpu_cores": stats["used_cpu_cores"],
+        "storage_gb": stats["used_storage_gb"],
+    }
+
+
+def series_key(entity_type, entity):
+    return f"{entity_type}|{entity}"
+
+
+def load_series(keys):
+    """Load {series key: MetricSeries} for the keys that exist, in one query"""
+    if not keys:
+        return {}
+    rows = frappe.get_all("Metric Series", filters={"name": ["in", list(keys)]}, fields=["name", "data"])
+    return {row.name: MetricSeries.from_blob(row.data) for row in rows}
+
+
+def record_samples(entity_type, samples, metrics=SERVER_METRICS, ts=None):
+    """Append one sample per entity and persist every touched series in one upsert
+
+    samples maps entity name -> {metric: value}.
+    """
+    ts = int(ts or time.time())
+    record_batch({(entity_type, entity): [(ts, sample)] for entity, sample in samples.items()},
+                 {entity_type: metrics})
+
+
+def record_batch(points, metrics_by_type):
+    """Append many timestamped samples across entities in one read and one upsert
+
+    points maps (entity_type, entity) -> [(ts, {metric: value}), ...].
+    """
+    if not points:
+        return
+    keys = {series_key(*entity): entity for entity in points}
+    series = load_series(keys)
+
+    now = frappe.utils.now()
+    rows = []
+    for key, (entity_type, entity) in keys.items():
+        s = series.get(key) or MetricSeries(metrics_by_type[entity_type])
+        entity_points = sorted(points[(entity_type, entity)], key=lambda point: point[0])
+        for ts, sample in entity_points:
+            s.add(int(ts), sample)
+        last_ts = int(entity_points[-1][0])
+        rows.append((key, entity_type, entity, s.to_blob(), last_ts, now, now,
+                     frappe.session.user, frappe.session.user))
+
+    frappe.db.sql(
+        """
+        insert into `tabMetric Series`
+            (name, entity_type, entity, data, last_sample_ts, creation, modified, owner, modified_by)
+        values {}
+        on duplicate key update
+            data = values(data), last_sample_ts = values(last_sample_ts), modified = values(modified)
+        """.format(", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(rows))),
+        [value for row in rows for value in row],
+    )
+
+
+@frappe.whitelist()
+def get_metric_history(entity_type, entity, metric, start, end=None):
+    """Dashboard range query: [[ts, value], ...] for one metric"""
+    frappe.only_for("System Manager")
+    series = load_series([series_key(entity_type, entity)]).get(series_key(entity_type, entity))
+    if not series:
+        return []
+    return series.query(metric, int(start), int(end) if end else None)
@@ -1,46 +1,120 @@
 """
-Monitoring utilities for AppZ Hosting - Client Site monitoring
+Monitoring utilities for AppZ Hosting - Client Site and server fleet monitoring
 """
 
+import json
+import time
+
 import frappe
 from frappe.utils import now_datetime
-import requests
+
+from appz_hosting.core.agent import get_agent_servers
+from appz_hosting.core.capacity import reconcile_servers
+from appz_hosting.core.fleet import SSH_KEY_FIELDS, get_fleet_targets, run_on_fleet
+from appz_hosting.core.health import get_healthcheck_paths, run_health_checks, site_url
+from appz_hosting.core.metrics import CONTAINER_METRICS, record_samples, server_sample
+from appz_hosting.core.stats import (
+    CONTAINER_STATS_PROBE,
+    SERVER_STATS_PROBE,
+    parse_container_stats,
+    parse_server_stats,
+)
+
+
+HEALTH_CHECK_INTERVAL = 300  # seconds a fleet sweep should comfortably finish within
+SUMMARY_CACHE_TTL = 60  # seconds a client's health summary is served from cache
+SITE_HEALTH_KEY = "appz_site_health"  # Redis hash: site name -> latest check result
+DOCKER_MARKER = "__appz_docker__"
+
+# Stats probe plus a Docker daemon check, in one round trip per host
+HEALTH_PROBE = SERVER_STATS_PROBE + f"""echo {DOCKER_MARKER}
+timeout 10 docker info --format '{{{{.ServerVersion}}}}' >/dev/null 2>&1 && echo up || echo down
+"""
 
 
 def check_all_client_sites():
-    """Daily: Check health of all active client sites"""
+    """Check health of all active client sites at once"""
     sites = frappe.get_all(
         "Client Site",
         filters={"status": "Active"},
         fields=["name", "client", "site_type", "domain", "server"],
     )
 
+    results = check_sites(sites)
     for site in sites:
         try:
-            check_site_health(site)
+            _record_site_health(site, results.get(site.name))
         except Exception as e:
             frappe.log_error(f"Failed to check site {site.name}: {e}")
 
+    for client in {site.client for site in sites}:
+        frappe.cache().delete_value(_summary_cache_key(client))
     frappe.db.commit()
 
 
+def check_sites(sites):
+    """Check all sites with a domain concurrently, returning {site name: result}"""
+    paths = get_healthcheck_paths()
+    targets = [
+        {"name": site.name, "url": site_url(site.domain, paths.get(site.site_type, "/"))}
+        for site in sites
+        if site.domain
+    ]
+    return {result["name"]: result for result in run_health_checks(targets)}
+
+
 def check_site_health(site):
     """Check health of a single client site"""
     if not site.domain:
         return
 
-    # Check if site is reachable
-    try:
-        url = f"https://{site.domain}"
-        response = requests.get(url, timeout=15, verify=True)
-        healthy = response.status_code < 400
-    except Exception:
-        healthy = False
+    _record_site_health(site, check_sites([site]).get(site.name))
+
+
+def check_site_list(site_names):
+    """Check the given sites now; returns {site name: healthy} for every name"""
+    sites = frappe.get_all(
+        "Client Site",
+        filters={"name": ["in", site_names], "status": "Active"},
+        fields=["name", "client", "site_type", "domain", "server"],
+    )
+    results = check_sites(sites)
+    for site in sites:
+        try:
+            _record_site_health(site, results.get(site.name))
+        except Exception as e:
+            frappe.log_error(f"Failed to check site {site.name}: {e}")
+
+    for client in {site.client for site in sites}:
+        frappe.cache().delete_value(_summary_cache_key(client))
+
+    # Sites without a domain, or no longer active, count as passing
+    return {name: results[name]["healthy"] if name in results else True for name in site_names}
+
+
+def check_client_sites(client_name):
+    """Check every site of one client now and drop its cached summary"""
+    sites = frappe.get_all(
+        "Client Site",
+        filters={"client": client_name, "status": "Active"},
+        fields=["name", "client", "site_type", "domain", "server"],
+    )
+    results = check_sites(sites)
+    for site in sites:
+        _record_site_health(site, results.get(site.name))
+
+    frappe.cache().delete_value(_summary_cache_key(client_name))
+    frappe.publish_realtime("appz_client_health_refreshed", {"client": client_name})
+
+
+def _record_site_health(site, result):
+    if result:
+        frappe.cache().hset(SITE_HEALTH_KEY, site.name, dict(result, checked_at=str(now_datetime())))
 
     # Log result (could extend to store in a log table)
-    if not healthy:
+    if result and not result["healthy"]:
         frappe.log_error(
-            f"Site health check failed: {site.domain}",
+            f"Site health check failed: {site.domain} ({result['error'] or result['status_code']})",
             f"Client Site: {site.name}",
         )
 
@@ -49,6 +123,11 @@ def check_site_health(site):
         check_site_backup_status(site)
 
 
+def get_site_health(site_name):
+    """Latest stored health check result for a site, or None if never checked"""
+    return frappe.cache().hget(SITE_HEALTH_KEY, site_name)
+
+
 def check_site_backup_status(site):
     """Check backup status for a site"""
     # Get latest backup if using S3
@@ -57,7 +136,30 @@ def check_site_backup_status(site):
 
 
 def get_client_health_summary(client_name):
-    """Get health summary for all sites of a client"""
+    """Get health summary for all sites of a client from the latest stored checks"""
+    cache_key = _summary_cache_key(client_name)
+    summary = frappe.cache().get_value(cache_key)
+    if summary is None:
+        summary = _build_health_summary(client_name)
+        frappe.cache().set_value(cache_key, summary, expires_in_sec=SUMMARY_CACHE_TTL)
+    return summary
+
+
+@frappe.whitelist()
+def refresh_client_health(client_name):
+    """Re-check every site of a client in the background"""
+    frappe.has_permission("Client", "read", client_name, throw=True)
+    frappe.enqueue(
+        "appz_hosting.core.monitoring.check_client_sites",
+        queue="short",
+        job_id=f"appz_client_health|{client_name}",
+        deduplicate=True,
+        client_name=client_name,
+    )
+    return {"success": True, "queued": True}
+
+
+def _build_health_summary(client_name):
     sites = frappe.get_all(
         "Client Site",
         filters={"client": client_name, "status": "Active"},
@@ -65,21 +167,23 @@ def get_client_health_summary(client_name):
     )
 
     healthy = 0
+    unchecked = 0
     issues = []
+    checked_at = []
 
     for site in sites:
-        # Check if domain is accessible
-        if site.domain:
-            try:
-                response = requests.get(f"https://{site.domain}", timeout=10)
-                if response.status_code < 400:
-                    healthy += 1
-                else:
-                    issues.append(f"{site.site_name}: HTTP {response.status_code}")
-            except Exception as e:
-                issues.append(f"{site.site_name}: {str(e)[:50]}")
+        result = get_site_health(site.name) if site.domain else None
+        if site.domain and not result:
+            unchecked += 1
+
+        if not result or result["healthy"]:
+            healthy += 1  # No domain to check, not checked yet, or reachable
+        elif result["status_code"]:
+            issues.append(f"{site.site_name}: HTTP {result['status_code']}")
         else:
-            healthy += 1  # No domain to check
+            issues.append(f"{site.site_name}: {(result['error'] or '')[:50]}")
+        if result:
+            checked_at.append(result["checked_at"])
 
         # Check backup status
         if site.backup_status == "Failed":
@@ -88,47 +192,200 @@ def get_client_health_summary(client_name):
     return {
         "total_sites": len(sites),
         "healthy": healthy,
+        "unchecked": unchecked,
         "issues": issues,
         "health_percent": round(healthy / len(sites) * 100, 1) if sites else 100,
+        "oldest_check": min(checked_at) if checked_at else None,
     }
 
 
+def _summary_cache_key(client_name):
+    return f"appz_client_health|{client_name}"
+
+
 def update_server_capacity(server_name):
-    """Update capacity metrics for a server"""
+    """Update the measured host usage of a server
+
+    The used_* counters and service_count are kept by core.capacity; only
+    the host_* columns are written here.
+    """
     from appz_hosting.core.deployer import Deployer
 
+    if server_name in get_agent_servers("AppZ Server"):
+        return  # the stats agent keeps this server current
+
     try:
-        deployer = Deployer(server_name)
+        with Deployer(server_name) as deployer:
+            stats = deployer.get_server_stats()
 
-        # Get memory usage
-        mem_result = deployer._exec("free -m | grep Mem | awk '{print $3}'")
-        used_ram_mb = int(mem_result["stdout"].strip()) if mem_result["stdout"].strip() else 0
+        frappe.db.set_value(
+            "AppZ Server", server_name, server_fields("AppZ Server", stats, now_datetime()), update_modified=False
+        )
+        record_samples("AppZ Server", {server_name: server_sample(stats)})
 
-        # Get CPU load
-        cpu_result = deployer._exec("top -bn1 | grep 'Cpu(s)' | awk '{print $2}'")
-        cpu_percent = float(cpu_result["stdout"].strip()) if cpu_result["stdout"].strip() else 0
+    except Exception as e:
+        frappe.log_error(f"Failed to update server capacity {server_name}: {e}")
 
-        # Get disk usage
-        disk_result = deployer._exec("df -BG / | tail -1 | awk '{print $3}' | tr -d 'G'")
-        used_storage_gb = int(disk_result["stdout"].strip()) if disk_result["stdout"].strip() else 0
 
-        deployer.close()
+def collect_container_stats():
+    """Hourly: actual usage of every hosted service, one SSH call per host"""
+    targets = get_fleet_targets(doctypes=("AppZ Server",))
+    results = run_on_fleet(CONTAINER_STATS_PROBE, targets=targets, timeout=180)
 
-        # Update server record
-        server = frappe.get_doc("AppZ Server", server_name)
-        server.used_ram_gb = round(used_ram_mb / 1024, 2)
-        server.used_cpu_cores = round(cpu_percent / 100 * server.total_cpu_cores, 2)
-        server.used_storage_gb = used_storage_gb
-        server.last_health_check = now_datetime()
+    servers = dict(frappe.get_all(
+        "Hosted Service",
+        filters={"status": ["in", ["Active", "Provisioning"]]},
+        fields=["name", "server"],
+        as_list=True,
+    ))
+    updates = {}
+    samples = {}
+    failures = []
 
-        # Calculate capacity percentage (based on RAM as primary constraint)
-        if server.total_ram_gb:
-            server.capacity_percent = round(server.used_ram_gb / server.total_ram_gb * 100, 1)
+    for target, result in zip(targets, results):
+        if not result["stdout"]:
+            failures.append(f"{target['server']}: {result['error'] or result['stderr'] or 'no output'}")
+            continue
 
-        # Count client sites on this server
-        server.service_count = frappe.db.count("Client Site", {"server": server_name, "status": "Active"})
+        for service, usage in parse_container_stats(result["stdout"]).items():
+            # Only services the database places on this server; Deployed Apps share the naming
+            if servers.get(service) != target["server"]:
+                continue
+            updates[service] = {
+                "actual_ram_mb": usage["ram_mb"],
+                "actual_cpu_percent": usage["cpu_percent"],
+                "actual_storage_gb": usage["storage_gb"],
+            }
+            samples[service] = usage
 
-        server.save(ignore_permissions=True)
+    if updates:
+        frappe.db.bulk_update("Hosted Service", updates, update_modified=False)
+        # bulk_update skips doc events, so recount the affected servers' usage
+        reconcile_servers({servers[name] for name in updates})
+    record_samples("Hosted Service", samples, metrics=CONTAINER_METRICS)
+    frappe.db.commit()
 
-    except Exception as e:
-        frappe.log_error(f"Failed to update server capacity {server_name}: {e}")
+    if failures:
+        frappe.log_error("\n".join(failures), "Container Stats")
+    return {"servers": len(targets), "services": len(updates), "failed": len(failures)}
+
+
+def get_server_stats(server_name, doctype="Customer Server"):
+    """Get live stats for one server"""
+    from appz_hosting.core.deployer import Deployer
+
+    with Deployer(server_name, doctype=doctype) as deployer:
+        return deployer.get_server_stats()
+
+
+def health_check_all_servers():
+    """Liveness, stats and Docker health for every server at once
+
+    Scheduled checks go through check_schedule.run_due_checks, which probes
+    each server at its own adaptive interval.
+    """
+    return sweep_servers(HEALTH_PROBE)
+
+
+def collect_server_stats():
+    """Daily: collect stats for every server"""
+    return sweep_servers(SERVER_STATS_PROBE)
+
+
+def sweep_servers(probe, targets=None):
+    """Probe servers (default: every active one) in parallel and bulk-update the results"""
+    started = time.monotonic()
+    # Servers with a live stats agent report themselves
+    agent_servers = {doctype: get_agent_servers(doctype) for doctype in SSH_KEY_FIELDS}
+    if targets is None:
+        targets = get_fleet_targets()
+    targets = [t for t in targets if t["server"] not in agent_servers[t["doctype"]]]
+    results = run_on_fleet(probe, targets=targets, timeout=60)
+
+    capacity = {
+        s.name: s
+        for s in frappe.get_all("AppZ Server", filters={"status": "Active"},
+                                fields=["name", "total_cpu_cores"])
+    }
+    checked_at = now_datetime()
+    updates = {"AppZ Server": {}, "Customer Server": {}}
+    samples = {"AppZ Server": {}, "Customer Server": {}}
+    failures = []
+    failed_servers = []
+
+    for target, result in zip(targets, results):
+        try:
+            stats, docker_up = parse_health_probe(result, capacity.get(target["server"]))
+        except Exception as e:
+            failures.append(f"{target['doctype']} {target['server']}: {result['error'] or e}")
+            failed_servers.append(f"{target['doctype']}|{target['server']}")
+            continue
+
+        if docker_up is False:
+            failures.append(f"{target['doctype']} {target['server']}: Docker daemon not responding")
+            failed_servers.append(f"{target['doctype']}|{target['server']}")
+
+        updates[target["doctype"]][target["server"]] = server_fields(
+            target["doctype"], stats, checked_at, capacity.get(target["server"])
+        )
+        samples[target["doctype"]][target["server"]] = server_sample(stats)
+
+    for doctype, doc_updates in updates.items():
+        if doc_updates:
+            frappe.db.bulk_update(doctype, doc_updates, update_modified=False)
+        record_samples(doctype, samples[doctype])
+    frappe.db.commit()
+
+    summary = {
+        "servers": len(targets),
+        "agent_servers": sum(len(names) for names in agent_servers.values()),
+        "updated": sum(len(u) for u in updates.values()),
+        "failed": len(failures),
+        "duration": round(time.monotonic() - started, 2),
+        "finished_at": str(checked_at),
+    }
+    frappe.cache().set_value("appz_last_server_sweep", summary)
+    frappe.logger("appz_monitoring").info(f"Server sweep: {json.dumps(summary)}")
+    summary["failed_servers"] = failed_servers
+
+    if failures:
+        frappe.log_error("\n".join(failures), "Server Health Check")
+    if summary["duration"] > HEALTH_CHECK_INTERVAL * 0.8:
+        frappe.log_error(
+            f"Server sweep took {summary['duration']}s for {summary['servers']} servers, "
+            f"close to the {HEALTH_CHECK_INTERVAL}s schedule interval",
+            "Server Health Check",
+        )
+
+    return summary
+
+
+def parse_health_probe(result, server=None):
+    """Split a fleet probe result into (stats, docker_up); docker_up is None if not checked"""
+    if not result["success"] and not result["stdout"]:
+        raise Exception(result["error"] or result["stderr"] or "probe failed")
+
+    stats_output, _, docker_output = result["stdout"].partition(DOCKER_MARKER)
+    stats = parse_server_stats(stats_output, server.total_cpu_cores if server else None)
+    docker_up = docker_output.strip() == "up" if docker_output else None
+    return stats, docker_up
+
+
+def server_fields(doctype, stats, checked_at, server=None):
+    """Record fields for a server from parsed stats"""
+    if doctype == "AppZ Server":
+        # Measured on the host; used_* and capacity_percent are service counters (core.capacity)
+        return {
+            "host_ram_gb": stats["used_ram_gb"],
+            "host_cpu_cores": stats["used_cpu_cores"],
+            "host_storage_gb": stats["used_storage_gb"],
+            "last_health_check": checked_at,
+        }
+
+    return {
+        "cpu_percent": stats["cpu_percent"],
+        "ram_percent": round(stats["used_ram_gb"] / stats["total_ram_gb"] * 100, 1) if stats["total_ram_gb"] else 0,
+        "disk_percent": round(stats["used_storage_gb"] / stats["total_storage_gb"] * 100, 1)
+        if stats["total_storage_gb"] else 0,
+        "last_health_check": checked_at,
+    }
@@ -107,7 +107,7 @@ def bootstrap_server(server_name):
     from appz_hosting.core.deployer import Deployer
 
     try:
-        deployer = Deployer(server_name)
+        deployer = Deployer(server_name, doctype="Customer Server")
 
         # Install Docker
         deployer._exec(
@@ -135,10 +135,27 @@ def bootstrap_server(server_name):
         # Create app directory
         deployer._exec("mkdir -p /apps")
 
+        # Push stats instead of being polled over SSH
+        if frappe.conf.get("appz_stats_agent"):
+            from appz_hosting.core.agent import install_agent
+
+            install_agent(deployer)
+
         deployer.close()
 
         frappe.logger().info(f"Bootstrap complete for {server_name}")
 
+        # Warm template images so the first app deploy doesn't wait on pulls
+        from appz_hosting.core.images import WARM_JOB_TIMEOUT
+
+        frappe.enqueue(
+            "appz_hosting.core.images.warm_server_images",
+            queue="long",
+            timeout=WARM_JOB_TIMEOUT,
+            server_name=server_name,
+            doctype="Customer Server",
+        )
+
     except Exception as e:
         frappe.log_error(f"Bootstrap failed for {server_name}: {e}")
 
@@ -0,0 +1,431 @@
+"""
+Fleet Rebalancing for AppZ Hosting
+
+Plans and runs Hosted Service moves off AppZ Servers that are over their
+max_ram_percent / max_cpu_percent (or the 90% storage ceiling). Each move
+stops the service on the source, streams its data directory and its
+compose project's named volumes to the target, checks the copy and starts
+it there. The source keeps forwarding the domain to the
+target (a Service Migration in Forwarding) until DNS points at the target;
+only then is the source copy torn down. Moves run as background jobs,
+limited per server.
+"""
+
+import shlex
+import socket
+from contextlib import ExitStack
+
+import frappe
+import numpy as np
+from frappe.utils import now_datetime
+
+from appz_hosting.core import images
+from appz_hosting.core.locks import server_semaphore
+from appz_hosting.core.placement import Capacity, score
+
+
+MAX_MIGRATIONS_PER_SERVER = 1  # concurrent moves touching one server
+MAX_MOVES = 50  # per plan
+MIGRATION_TIMEOUT = 3600  # seconds for copying one service's data
+COPY_CHUNK_SIZE = 256 * 1024
+VOLUME_HELPER_IMAGE = "alpine:3"  # runs tar against a named volume
+# Paths and sizes of every file under the current directory, as one digest
+MANIFEST = "find . -type f -exec stat -c '%s %n' {} + | sort | md5sum"
+CERT_WAIT = 180  # seconds for the target to get a certificate for the moved domain
+DNS_GRACE_HOURS = 24  # keep forwarding this long after DNS switches, for cached lookups
+
+
+def _service_demand(service):
+    """(RAM GB, CPU cores, storage GB) a Hosted Service uses"""
+    return np.array([
+        (service.actual_ram_mb or 0) / 1024,
+        (service.actual_cpu_percent or 0) / 100,  # Docker reports 100% per core
+        service.actual_storage_gb or 0,
+    ])
+
+
+def plan_rebalance(strategy="best_fit", max_moves=MAX_MOVES):
+    """Plan moves that bring every AppZ Server under its thresholds
+
+    Greedy, hottest server first: move the smallest service that clears a
+    server's excess on its own, otherwise its largest service, to the best
+    server that still fits it. Returns {"moves": [...], "unresolved": [...]}.
+    """
+    capacity = Capacity.load()
+    if not len(capacity):
+        return {"moves": [], "unresolved": []}
+
+    index = {name: i for i, name in enumerate(capacity.names)}
+    services = {}
+    for service in frappe.get_all(
+        "Hosted Service",
+        filters={"status": "Active", "server": ["in", capacity.names]},
+        fields=["name", "server", "actual_ram_mb", "actual_cpu_percent", "actual_storage_gb"],
+    ):
+        services.setdefault(index[service.server], []).append((service.name, _service_demand(service)))
+
+    # Plan against a working copy so each move sees the previous ones
+    working = Capacity(capacity.names, capacity.used.copy(), capacity.total, capacity.limits)
+    ceilings = capacity.limits * capacity.total
+
+    def excess(i):
+        return np.maximum(working.used[i] - ceilings[i], 0)
+
+    hot = [i for i in range(len(capacity)) if excess(i).any() and (capacity.total[i] > 0).all()]
+    hot.sort(key=lambda i: -(working.used[i] / capacity.total[i] - capacity.limits[i]).max())
+
+    moves = []
+    unresolved = []
+    for i in hot:
+        candidates = dict(services.get(i, []))
+        # Share of the source server each service takes up
+        sizes = {name: (demand / capacity.total[i]).sum() for name, demand in candidates.items()}
+        while excess(i).any() and candidates and len(moves) < max_moves:
+            over = excess(i)
+            clears = [name for name, demand in candidates.items() if (demand >= over).all()]
+            name = min(clears, key=sizes.get) if clears else max(candidates, key=sizes.get)
+            demand = candidates.pop(name)
+
+            order, _ = score(working, demand, strategy)
+            targets = [t for t in order if t != i]
+            if not targets:
+                continue  # nowhere fits this one - try the next service
+
+            target = targets[0]
+            working.used[i] -= demand
+            working.used[target] += demand
+            moves.append({
+                "service": name,
+                "source": capacity.names[i],
+                "target": capacity.names[target],
+                "ram_gb": round(float(demand[0]), 2),
+                "cpu_cores": round(float(demand[1]), 2),
+                "storage_gb": round(float(demand[2]), 2),
+            })
+
+        if excess(i).any():
+            unresolved.append(capacity.names[i])
+
+    return {"moves": moves, "unresolved": unresolved}
+
+
+def execute_plan(moves):
+    """Queue one migration job per move; per-server limits are enforced by the jobs"""
+    for move in moves:
+        frappe.enqueue(
+            "appz_hosting.core.rebalance.migrate_service",
+            queue="long",
+            timeout=MIGRATION_TIMEOUT + 900,
+            job_id=f"appz_migrate|{move['service']}",
+            deduplicate=True,
+            service_name=move["service"],
+            target_server=move["target"],
+        )
+
+
+@frappe.whitelist()
+def rebalance_fleet(strategy="best_fit", dry_run=True):
+    """Plan a rebalance and, unless dry_run, start the moves"""
+    frappe.only_for("System Manager")
+    plan = plan_rebalance(strategy=strategy)
+    if not frappe.utils.cint(dry_run):
+        execute_plan(plan["moves"])
+    return plan
+
+
+def _stream(source, export_cmd, target, import_cmd):
+    """Pipe export_cmd's output on source into import_cmd on target through this worker"""
+    reader = source._open_channel(export_cmd, timeout=MIGRATION_TIMEOUT)
+    writer = target._open_channel(import_cmd, timeout=MIGRATION_TIMEOUT)
+    try:
+        while True:
+            data = reader.recv(COPY_CHUNK_SIZE)
+            if not data:
+                break
+            writer.sendall(data)
+        writer.shutdown_write()
+
+        if reader.recv_exit_status() != 0:
+            raise Exception(f"Export failed: {reader.makefile_stderr().read().decode(errors='replace')}")
+        if writer.recv_exit_status() != 0:
+            raise Exception(f"Import failed: {writer.makefile_stderr().read().decode(errors='replace')}")
+    finally:
+        reader.close()
+        writer.close()
+
+
+def _in_volume(volume, cmd, stdin=False):
+    """Command running cmd inside a named volume in a throwaway container"""
+    mount = f"{volume}:/v" if stdin else f"{volume}:/v:ro"
+    return (
+        f"docker run --rm {'-i ' if stdin else ''}-v {shlex.quote(mount)} -w /v "
+        f"{VOLUME_HELPER_IMAGE} sh -c {shlex.quote(cmd)}"
+    )
+
+
+def _service_volumes(deployer, service_name):
+    """Named volumes Docker Compose created for a service's project"""
+    quoted = shlex.quote(service_name)
+    result = deployer._exec(
+        f"cd /apps/{quoted} && project=$(docker compose config | sed -n 's/^name: //p') "
+        f'&& [ -n "$project" ] && docker volume ls -q --filter "label=com.docker.compose.project=$project"'
+    )
+    if result["exit_code"] != 0:
+        raise Exception(f"Listing volumes of {service_name} failed: {result['stderr']}")
+    return result["stdout"].split()
+
+
+def _copy_service_data(source, target, service_name):
+    """Stream /apps/<service> from source to target"""
+    quoted = shlex.quote(service_name)
+    _stream(
+        source, f"tar -C /apps -czf - {quoted}",
+        target, f"rm -rf /apps/{quoted} && mkdir -p /apps && tar -C /apps -xzf -",
+    )
+
+
+def _copy_volumes(source, target, volumes):
+    """Stream named volumes into the volumes of the same name on target"""
+    for volume in volumes:
+        _stream(
+            source, _in_volume(volume, "tar -czf - ."),
+            target, _in_volume(volume, "find . -mindepth 1 -delete && tar -xzf -", stdin=True),
+        )
+
+
+def _verify_copy(source, target, service_name, volumes):
+    """Raise unless the target holds the same files, with the same sizes, as the source"""
+    checks = {f"/apps/{service_name}": f"cd /apps/{shlex.quote(service_name)} && {MANIFEST}"}
+    checks.update({f"volume {volume}": _in_volume(volume, MANIFEST) for volume in volumes})
+    for label, cmd in checks.items():
+        expected = source._exec(cmd, timeout=MIGRATION_TIMEOUT)
+        copied = target._exec(cmd, timeout=MIGRATION_TIMEOUT)
+        if expected["exit_code"] != 0 or copied["exit_code"] != 0 or expected["stdout"] != copied["stdout"]:
+            raise Exception(f"Copy of {label} does not match the source")
+
+
+def migrate_service(service_name, target_server):
+    """Move one Hosted Service to another AppZ Server"""
+    from appz_hosting.core.caddy import apply_service_routes
+    from appz_hosting.core.deployer import Deployer
+
+    service = frappe.get_doc("Hosted Service", service_name)
+    source_server = service.server
+    if source_server == target_server:
+        return {"success": True, "skipped": True}
+
+    # The source still holds the previous copy and serves its forward
+    pending = frappe.db.get_value(
+        "Service Migration", {"service": service_name, "status": ["in", ["Switching", "Forwarding"]]}
+    )
+    if pending:
+        return {"success": False, "error": f"Previous move {pending} is still forwarding"}
+
+    limit = frappe.conf.get("appz_max_migrations_per_server", MAX_MIGRATIONS_PER_SERVER)
+    quoted = shlex.quote(service_name)
+
+    with ExitStack() as stack:
+        # Same order everywhere, so opposite moves can't deadlock
+        for server in sorted([source_server, target_server]):
+            stack.enter_context(server_semaphore(
+                server, "migrate", limit=limit, wait=MIGRATION_TIMEOUT, ttl=MIGRATION_TIMEOUT + 900
+            ))
+        source = stack.enter_context(Deployer(source_server))
+        target = stack.enter_context(Deployer(target_server))
+
+        # Stop first so the copied data is consistent
+        result = source._exec(f"cd /apps/{quoted} && docker compose stop", timeout=300)
+        if result["exit_code"] != 0:
+            raise Exception(f"Stopping {service_name} on {source_server} failed: {result['stderr']}")
+
+        try:
+            volumes = _service_volumes(source, service_name)
+            _copy_service_data(source, target, service_name)
+            compose = target._exec(f"cat /apps/{quoted}/docker-compose.yml")["stdout"]
+            images.ensure_images(target, compose)
+            # Let Compose create the volumes, with its labels, before filling them
+            result = target._exec(f"cd /apps/{quoted} && docker compose up --no-start", timeout=300)
+            if result["exit_code"] != 0:
+                raise Exception(f"Creating on {target_server} failed: {result['stderr']}")
+            _copy_volumes(source, target, volumes)
+            _verify_copy(source, target, service_name, volumes)
+
+            result = target._exec(f"cd /apps/{quoted} && docker compose up -d", timeout=300)
+            if result["exit_code"] != 0:
+                raise Exception(f"Starting on {target_server} failed: {result['stderr']}")
+        except Exception as e:
+            # Leave the service where it was
+            _abandon_target(source, target, service_name)
+            frappe.log_error(f"Migration of {service_name} to {target_server} failed: {e}", "Rebalance")
+            return {"success": False, "error": str(e)}
+
+        migration = None
+        try:
+            migration = frappe.get_doc({
+                "doctype": "Service Migration",
+                "service": service_name,
+                "domain": service.domain,
+                "source_server": source_server,
+                "target_server": target_server,
+                "status": "Switching",
+                "started_at": now_datetime(),
+                "data_verified": 1,
+            }).insert(ignore_permissions=True)
+
+            # Capacity counters and the domain index follow the doc events
+            service.server = target_server
+            service.save(ignore_permissions=True)
+            frappe.db.commit()
+
+            apply_service_routes(target, [service_name])
+            # DNS still points at the source, so it swaps the service's route
+            # for a forward to the target
+            source._update_caddy()
+        except Exception as e:
+            _switch_back(service_name, source_server, migration, source, target)
+            frappe.log_error(f"Switching {service_name} to {target_server} failed: {e}", "Rebalance")
+            return {"success": False, "error": str(e)}
+
+        # The stopped copy stays until finish_migrations sees DNS move
+        migration.db_set("status", "Forwarding")
+        frappe.db.commit()
+
+        forwarding = False
+        try:
+            forwarding = not service.domain or _wait_for_certificate(target, service.domain)
+            if not forwarding:
+                frappe.log_error(
+                    f"{target_server} has no certificate for {service.domain} yet; "
+                    f"the forward from {source_server} fails until it does",
+                    "Rebalance",
+                )
+        except Exception as e:
+            frappe.log_error(f"Forwarding {service_name} from {source_server} failed: {e}", "Rebalance")
+
+    return {
+        "success": True,
+        "source": source_server,
+        "target": target_server,
+        "migration": migration.name,
+        "forwarding": forwarding,
+    }
+
+
+def _abandon_target(source, target, service_name):
+    """Remove the target's copy of a service and start it on the source again"""
+    quoted = shlex.quote(service_name)
+    target._exec(f"cd /apps/{quoted} && docker compose down -v; rm -rf /apps/{quoted}", timeout=300)
+    target._forget_hashes(f"/apps/{service_name}/")
+    source._exec(f"cd /apps/{quoted} && docker compose start", timeout=300)
+
+
+def _switch_back(service_name, source_server, migration, source, target):
+    """Undo a move whose routes could not be switched over to the target"""
+    from appz_hosting.core.caddy import reconcile_caddy
+
+    frappe.db.rollback()
+    if frappe.db.get_value("Hosted Service", service_name, "server") != source_server:
+        service = frappe.get_doc("Hosted Service", service_name)
+        service.server = source_server
+        service.save(ignore_permissions=True)
+    if migration and frappe.db.exists("Service Migration", migration.name):
+        migration.db_set("status", "Failed")
+    frappe.db.commit()
+
+    _abandon_target(source, target, service_name)
+    # Both Caddyfiles are rebuilt from the restored records
+    for deployer in (source, target):
+        try:
+            reconcile_caddy(deployer)
+        except Exception as e:
+            frappe.log_error(f"Restoring Caddy on {deployer.server.name} failed: {e}", "Rebalance")
+
+
+def _wait_for_certificate(target, domain):
+    """Whether the target serves domain with a valid certificate within CERT_WAIT"""
+    quoted = shlex.quote(domain)
+    probe = f"curl -s -o /dev/null --max-time 10 --resolve {quoted}:443:127.0.0.1 https://{quoted}/"
+    result = target._exec(
+        f"end=$(($(date +%s) + {CERT_WAIT})); "
+        f"while [ $(date +%s) -lt $end ]; do {probe} && exit 0; sleep 5; done; exit 1",
+        timeout=CERT_WAIT + 30,
+    )
+    return result["exit_code"] == 0
+
+
+def _resolve(domain):
+    """IP addresses a domain currently resolves to"""
+    try:
+        return {info[4][0] for info in socket.getaddrinfo(domain, 443, proto=socket.IPPROTO_TCP)}
+    except socket.gaierror:
+        return set()
+
+
+def finish_migration(migration_name):
+    """Tear down the source copy of a moved service and stop forwarding its domain"""
+    from appz_hosting.core.caddy import reconcile_caddy
+    from appz_hosting.core.deployer import Deployer
+
+    migration = frappe.get_doc("Service Migration", migration_name)
+    if migration.status != "Forwarding":
+        return
+    quoted = shlex.quote(migration.service)
+
+    # Volumes are only dropped once the copy on the target has been checked
+    down = "docker compose down -v" if migration.data_verified else "docker compose down"
+    with Deployer(migration.source_server) as source:
+        source._exec(f"cd /apps/{quoted} && {down}; rm -rf /apps/{quoted}", timeout=300)
+        source._forget_hashes(f"/apps/{migration.service}/")
+
+        migration.status = "Completed"
+        migration.completed_at = now_datetime()
+        migration.save(ignore_permissions=True)
+        frappe.db.commit()
+
+        # The forward blocks live in the Caddyfile, so only a full reload drops them
+        reconcile_caddy(source)
+
+
+def finish_migrations():
+    """Hourly: finish moves whose domain has resolved to the target for DNS_GRACE_HOURS"""
+    migrations = frappe.get_all(
+        "Service Migration",
+        filters={"status": "Forwarding"},
+        fields=["name", "domain", "source_server", "target_server", "dns_switched_at"],
+    )
+    if not migrations:
+        return
+
+    addresses = dict(frappe.get_all("AppZ Server", fields=["name", "ip_address"], as_list=True))
+    now = now_datetime()
+    for migration in migrations:
+        try:
+            if migration.domain:
+                resolved = _resolve(migration.domain)
+                switched = (
+                    addresses.get(migration.target_server) in resolved
+                    and addresses.get(migration.source_server) not in resolved
+                )
+                if not switched:
+                    if migration.dns_switched_at:
+                        # Changed back, or only some resolvers had it - start over
+                        frappe.db.set_value("Service Migration", migration.name, "dns_switched_at", None)
+                    continue
+                if not migration.dns_switched_at:
+                    frappe.db.set_value("Service Migration", migration.name, "dns_switched_at", now)
+                    continue
+                if (now - migration.dns_switched_at).total_seconds() < DNS_GRACE_HOURS * 3600:
+                    continue
+
+            finish_migration(migration.name)
+        except Exception as e:
+            frappe.log_error(f"Finishing migration {migration.name} failed: {e}", "Rebalance")
+    frappe.db.commit()
+
+
+@frappe.whitelist()
+def complete_migration(migration):
+    """Finish a move now, e.g. for a domain behind a CDN whose DNS never shows the target"""
+    frappe.only_for("System Manager")
+    finish_migration(migration)
+    return {"success": True}
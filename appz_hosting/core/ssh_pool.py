@@ -0,0 +1,155 @@
+"""
+SSH Connection Pool for AppZ Hosting
+
+Keeps SSH connections to servers open across jobs in a worker process so
+Deployer instances borrow an existing transport instead of handshaking again.
+"""
+
+import os
+import threading
+import time
+from collections import defaultdict
+
+import frappe
+import paramiko
+
+
+DEFAULT_MAX_PER_HOST = 4
+DEFAULT_IDLE_TIMEOUT = 300  # seconds
+DEFAULT_KEEPALIVE = 30  # seconds
+DEFAULT_CONNECT_TIMEOUT = 30  # seconds
+
+
+class SSHConnectionPool:
+    """Process-wide pool of paramiko SSH clients, keyed by server"""
+
+    def __init__(
+        self,
+        max_per_host=DEFAULT_MAX_PER_HOST,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        keepalive=DEFAULT_KEEPALIVE,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+    ):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)  # key -> [(client, last_used)]
+        self._slots = {}  # key -> BoundedSemaphore
+        self._keys = {}  # key_path -> (mtime, PKey)
+
+    def acquire(self, host, key_path=None, username="root", wait=60):
+        """Borrow a live client for host, connecting if none is idle"""
+        key = (host, username, key_path)
+        if not self._slot(key).acquire(timeout=wait):
+            raise TimeoutError(f"No free SSH connection to {host} after {wait}s")
+
+        try:
+            self.evict_idle()
+            with self._lock:
+                idle = self._idle[key]
+                while idle:
+                    client, _ = idle.pop()
+                    if _is_alive(client):
+                        return client
+                    client.close()
+
+            return self._open(host, username, key_path)
+        except Exception:
+            self._slot(key).release()
+            raise
+
+    def release(self, host, client, key_path=None, username="root", discard=False):
+        """Return a borrowed client to the pool"""
+        key = (host, username, key_path)
+        try:
+            if discard or not _is_alive(client):
+                client.close()
+            else:
+                with self._lock:
+                    self._idle[key].append((client, time.monotonic()))
+        finally:
+            self._slot(key).release()
+
+    def evict_idle(self):
+        """Close connections that have been idle longer than idle_timeout"""
+        cutoff = time.monotonic() - self.idle_timeout
+        stale = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                keep = []
+                for client, last_used in idle:
+                    if last_used < cutoff or not _is_alive(client):
+                        stale.append(client)
+                    else:
+                        keep.append((client, last_used))
+                self._idle[key] = keep
+
+        for client in stale:
+            client.close()
+
+    def close_all(self):
+        """Close every idle connection in the pool"""
+        with self._lock:
+            idle, self._idle = self._idle, defaultdict(list)
+
+        for clients in idle.values():
+            for client, _ in clients:
+                client.close()
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_per_host)
+            return self._slots[key]
+
+    def _open(self, host, username, key_path):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(
+            host,
+            username=username,
+            pkey=self._load_key(key_path),
+            timeout=self.connect_timeout,
+        )
+        ssh.get_transport().set_keepalive(self.keepalive)
+        return ssh
+
+    def _load_key(self, key_path):
+        """Load a private key once, reloading only if the file changes"""
+        key_path = key_path or os.path.expanduser("~/.ssh/id_rsa")
+        mtime = os.path.getmtime(key_path)
+
+        with self._lock:
+            cached = self._keys.get(key_path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+
+        pkey = paramiko.RSAKey.from_private_key_file(key_path)
+        with self._lock:
+            self._keys[key_path] = (mtime, pkey)
+        return pkey
+
+
+def _is_alive(client):
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Get the pool shared by all jobs in this worker process"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = SSHConnectionPool(
+                    max_per_host=frappe.conf.get("ssh_pool_max_per_host", DEFAULT_MAX_PER_HOST),
+                    idle_timeout=frappe.conf.get("ssh_pool_idle_timeout", DEFAULT_IDLE_TIMEOUT),
+                )
+    return _pool
@@ -0,0 +1,176 @@
+"""
+Server Stats Probe for AppZ Hosting
+
+Collects memory, CPU, load and disk usage in a single SSH round trip.
+"""
+
+import json
+
+
+# Runs on the server with the system python3, either once per SSH probe or
+# in a loop inside the stats agent. CPU usage is the delta between two
+# /proc/stat samples, so it reflects current load rather than top's
+# since-boot first frame.
+SAMPLE_SOURCE = """import json, os, time
+
+def cpu_sample():
+    with open("/proc/stat") as f:
+        values = [int(v) for v in f.readline().split()[1:9]]
+    return sum(values), values[3] + values[4]
+
+def sample_server():
+    total_1, idle_1 = cpu_sample()
+    time.sleep(0.5)
+    total_2, idle_2 = cpu_sample()
+    busy = (total_2 - total_1) - (idle_2 - idle_1)
+    cpu_percent = busy / (total_2 - total_1) * 100 if total_2 > total_1 else 0
+
+    meminfo = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            meminfo[key] = int(value.split()[0])
+
+    with open("/proc/loadavg") as f:
+        load = [float(v) for v in f.read().split()[:3]]
+
+    disk_path = "/apps" if os.path.isdir("/apps") else "/"
+    vfs = os.statvfs(disk_path)
+
+    return {
+        "cpu_count": os.cpu_count(),
+        "cpu_percent": cpu_percent,
+        "load": load,
+        "mem_total_kb": meminfo["MemTotal"],
+        "mem_available_kb": meminfo.get("MemAvailable", meminfo["MemFree"]),
+        "disk_path": disk_path,
+        "disk_total_bytes": vfs.f_blocks * vfs.f_frsize,
+        "disk_free_bytes": vfs.f_bavail * vfs.f_frsize,
+        "disk_used_bytes": (vfs.f_blocks - vfs.f_bfree) * vfs.f_frsize,
+    }
+"""
+
+SERVER_STATS_PROBE = f"""python3 - <<'APPZ_PROBE'
+{SAMPLE_SOURCE}
+print(json.dumps(sample_server()))
+APPZ_PROBE
+"""
+
+KB_PER_GB = 1024 * 1024
+BYTES_PER_GB = 1024 ** 3
+
+
+def parse_server_stats(output, total_cpu_cores=None):
+    """Parse SERVER_STATS_PROBE output into capacity figures"""
+    return server_stats(json.loads(output), total_cpu_cores)
+
+
+def server_stats(raw, total_cpu_cores=None):
+    """Capacity figures from one sample_server() result"""
+    cpu_cores = total_cpu_cores or raw.get("cpu_count") or 1
+    cpu_percent = round(raw["cpu_percent"], 1)
+    used_ram_kb = raw["mem_total_kb"] - raw["mem_available_kb"]
+
+    return {
+        "used_ram_gb": round(used_ram_kb / KB_PER_GB, 2),
+        "total_ram_gb": round(raw["mem_total_kb"] / KB_PER_GB, 2),
+        "cpu_percent": cpu_percent,
+        "used_cpu_cores": round(cpu_percent / 100 * cpu_cores, 2),
+        "load_avg": raw["load"],
+        "used_storage_gb": round(raw["disk_used_bytes"] / BYTES_PER_GB, 2),
+        "total_storage_gb": round(raw["disk_total_bytes"] / BYTES_PER_GB, 2),
+        "disk_path": raw["disk_path"],
+    }
+
+
+# One round trip per host for every container: live usage, the labels that
+# tie containers to services, writable layer and volume sizes, and the size
+# of each service's bind-mounted data under /apps.
+CONTAINER_SECTION = "__appz_section__"
+CONTAINER_STATS_PROBE = f"""docker stats --no-stream --format '{{{{json .}}}}'
+echo {CONTAINER_SECTION}
+docker ps -a --format '{{{{.Names}}}}\\t{{{{.Label "appz.service"}}}}'
+echo {CONTAINER_SECTION}
+docker system df -v --format '{{{{json .}}}}'
+echo {CONTAINER_SECTION}
+timeout 120 nice -n 19 du -sk /apps/*/ 2>/dev/null
+"""
+
+SIZE_UNITS = {
+    "b": 1, "kb": 1e3, "mb": 1e6, "gb": 1e9, "tb": 1e12,
+    "kib": 1024, "mib": 1024 ** 2, "gib": 1024 ** 3, "tib": 1024 ** 4,
+}
+
+
+def parse_size(size):
+    """Bytes in a Docker size string such as '12.5MiB' or '1.2GB'"""
+    size = size.strip().lower()
+    number = size.rstrip("abcdefghijklmnopqrstuvwxyz")
+    try:
+        return float(number) * SIZE_UNITS.get(size[len(number):].strip(), 1)
+    except ValueError:
+        return 0.0
+
+
+def container_service(name, label=None):
+    """Service a container belongs to: its appz.service label, else <service>-app naming"""
+    if label:
+        return label
+    if name.endswith("-app"):
+        return name[: -len("-app")]
+    return None
+
+
+def parse_container_stats(output):
+    """Parse CONTAINER_STATS_PROBE output into {service: usage}"""
+    sections = (output.split(CONTAINER_SECTION) + ["", "", "", ""])[:4]
+    stats_out, labels_out, df_out, du_out = sections
+
+    services = {}
+    for line in labels_out.strip().splitlines():
+        name, _, label = line.partition("\t")
+        services[name] = container_service(name, label.strip())
+
+    usage = {}
+
+    def add(service, metric, value):
+        if service:
+            entry = usage.setdefault(service, {"ram_mb": 0.0, "cpu_percent": 0.0, "storage_gb": 0.0})
+            entry[metric] += value
+
+    for line in stats_out.strip().splitlines():
+        try:
+            row = json.loads(line)
+        except ValueError:
+            continue
+        service = services.get(row["Name"], container_service(row["Name"]))
+        add(service, "ram_mb", parse_size(row["MemUsage"].split("/")[0]) / 1024 ** 2)
+        add(service, "cpu_percent", float(row["CPUPerc"].rstrip("%") or 0))
+
+    if df_out.strip():
+        try:
+            df = json.loads(df_out)
+        except ValueError:
+            df = {}
+        for container in df.get("Containers") or []:
+            name = container["Names"].split(",")[0]
+            add(services.get(name, container_service(name)), "storage_gb",
+                parse_size(container.get("Size") or "0") / BYTES_PER_GB)
+        for volume in df.get("Volumes") or []:
+            labels = dict(
+                label.split("=", 1) for label in (volume.get("Labels") or "").split(",") if "=" in label
+            )
+            service = labels.get("appz.service") or labels.get("com.docker.compose.project")
+            if service in usage:
+                add(service, "storage_gb", parse_size(volume.get("Size") or "0") / BYTES_PER_GB)
+
+    for line in du_out.strip().splitlines():
+        kb, _, path = line.partition("\t")
+        service = path.rstrip("/").rsplit("/", 1)[-1]
+        if service in usage and kb.isdigit():
+            add(service, "storage_gb", int(kb) / KB_PER_GB)
+
+    return {
+        service: {metric: round(value, 2) for metric, value in entry.items()}
+        for service, entry in usage.items()
+    }
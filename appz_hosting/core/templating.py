@@ -0,0 +1,51 @@
+"""
+Template Rendering for AppZ Hosting
+
+Shared Jinja environment with a bounded cache of compiled templates, used
+for compose files, env files and OTel configs.
+"""
+
+import threading
+from collections import OrderedDict
+
+from jinja2 import Environment, StrictUndefined
+
+
+MAX_CACHED_TEMPLATES = 256
+
+# StrictUndefined makes a missing variable raise instead of rendering an
+# empty string into a compose file
+_environment = Environment(undefined=StrictUndefined, keep_trailing_newline=True)
+_compiled = OrderedDict()
+_lock = threading.Lock()
+
+
+def builtin_key(name):
+    """Cache key for a template string shipped with the app"""
+    return ("builtin", name)
+
+
+def doc_key(doc, fieldname):
+    """Cache key for a template stored on a document - changes whenever the doc is saved"""
+    return (doc.doctype, doc.name, fieldname, str(doc.modified))
+
+
+def get_template(key, source):
+    """Get the compiled template for key, compiling source on a miss"""
+    with _lock:
+        template = _compiled.get(key)
+        if template is not None:
+            _compiled.move_to_end(key)
+            return template
+
+    template = _environment.from_string(source)
+    with _lock:
+        _compiled[key] = template
+        while len(_compiled) > MAX_CACHED_TEMPLATES:
+            _compiled.popitem(last=False)
+    return template
+
+
+def render(key, source, **variables):
+    """Render source with variables, reusing the compiled template for key"""
+    return get_template(key, source).render(**variables)
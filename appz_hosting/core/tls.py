@@ -0,0 +1,112 @@
+"""
+On-demand TLS for AppZ Hosting
+
+Caddy asks authorize_domain before issuing a certificate for a domain it
+hasn't seen. Answers come from a domain -> service index kept in worker
+memory and shared through Redis, so a TLS handshake never queries MariaDB.
+"""
+
+import time
+
+import frappe
+
+
+INDEX_TTL = 300  # seconds before a worker rebuilds its copy of the index
+INDEX_CACHE_KEY = "appz_domain_index"
+INDEX_VERSION_KEY = "appz_domain_index_version"
+
+# Worker-local copy: {"domains": {domain: service}, "version": str, "loaded_at": float}
+_index = {"domains": None, "version": None, "loaded_at": 0.0}
+
+
+def is_enabled():
+    """Whether generated Caddyfiles use on-demand TLS"""
+    return bool(frappe.conf.get("caddy_on_demand_tls"))
+
+
+def get_ask_url():
+    """URL Caddy calls (with ?domain=) before issuing a certificate"""
+    return frappe.conf.get("caddy_ask_url") or frappe.utils.get_url(
+        "/api/method/appz_hosting.core.tls.authorize_domain"
+    )
+
+
+def build_domain_index():
+    """Map every routable domain to the Hosted Service or Deployed App serving it"""
+    domains = {}
+    for service in frappe.get_all(
+        "Hosted Service",
+        filters={"status": ["in", ["Active", "Provisioning"]], "domain": ["is", "set"]},
+        fields=["name", "domain"],
+    ):
+        domains[service.domain.lower()] = f"Hosted Service:{service.name}"
+
+    for app in frappe.get_all(
+        "Deployed App",
+        filters={"status": ["not in", ["Removed", "Error"]], "domain": ["is", "set"]},
+        fields=["name", "domain"],
+    ):
+        domains[app.domain.lower()] = f"Deployed App:{app.name}"
+
+    return domains
+
+
+def get_domain_index(refresh=False):
+    """Get the domain index, from worker memory, then Redis, then the database
+
+    refresh skips the worker's own copy.
+    """
+    now = time.monotonic()
+    if not refresh and _index["domains"] is not None and now - _index["loaded_at"] < INDEX_TTL:
+        return _index["domains"]
+
+    cache = frappe.cache()
+    domains = cache.get_value(INDEX_CACHE_KEY)
+    if domains is None:
+        domains = build_domain_index()
+        cache.set_value(INDEX_CACHE_KEY, domains, expires_in_sec=INDEX_TTL)
+
+    _index.update(domains=domains, version=cache.get_value(INDEX_VERSION_KEY), loaded_at=now)
+    return domains
+
+
+def lookup_domain(domain):
+    """Get the service serving domain, or None"""
+    domain = (domain or "").strip().lower().rstrip(".")
+    if not domain:
+        return None
+
+    service = get_domain_index().get(domain)
+    if service is None and _index["version"] != frappe.cache().get_value(INDEX_VERSION_KEY):
+        # A domain was added since this worker loaded the index - only misses pay
+        # for this Redis round trip, hits are answered from memory
+        service = get_domain_index(refresh=True).get(domain)
+    return service
+
+
+def invalidate_domain_index(doc=None, method=None):
+    """Drop the shared index when a domain or status changes
+
+    Dropped once the change commits - dropped earlier, a concurrent ask could
+    rebuild the index from the old rows and cache them for INDEX_TTL.
+    """
+    if doc is not None and method == "on_update":
+        if not (doc.has_value_changed("domain") or doc.has_value_changed("status")):
+            return
+
+    frappe.db.after_commit.add(_drop_domain_index)
+
+
+def _drop_domain_index():
+    cache = frappe.cache()
+    cache.delete_value(INDEX_CACHE_KEY)
+    cache.set_value(INDEX_VERSION_KEY, frappe.generate_hash(length=10))
+
+
+@frappe.whitelist(allow_guest=True)
+def authorize_domain(domain=None):
+    """Caddy on_demand_tls ask endpoint - 200 allows issuance, anything else refuses"""
+    if not lookup_domain(domain):
+        frappe.local.response.http_status_code = 404
+        return "unknown domain"
+    return "ok"
@@ -17,17 +17,25 @@ website_route_rules = [
 # Scheduled Tasks
 scheduler_events = {
     "cron": {
-        "*/5 * * * *": [
-            "appz_hosting.core.monitoring.health_check_all_servers",
+        "* * * * *": [
+            "appz_hosting.core.check_schedule.run_due_checks",
         ],
     },
     "hourly": [
+        "appz_hosting.core.capacity.reconcile_counters",
+        "appz_hosting.core.monitoring.collect_container_stats",
         "appz_hosting.core.backup.run_scheduled_backups",
+        "appz_hosting.core.rebalance.finish_migrations",
     ],
     "daily": [
         "appz_hosting.core.monitoring.collect_server_stats",
+        "appz_hosting.core.forecast.forecast_fleet",
         "appz_hosting.core.backup.cleanup_old_backups",
     ],
+    "daily_long": [
+        "appz_hosting.core.images.warm_all_servers",
+        "appz_hosting.core.caddy.reconcile_all_servers",
+    ],
 }
 
 # Installation
@@ -37,10 +45,40 @@ after_install = "appz_hosting.install.after_install"
 doc_events = {
     "Customer Server": {
         "after_insert": "appz_hosting.core.events.on_server_created",
-        "on_update": "appz_hosting.core.events.on_server_updated",
+        "on_update": [
+            "appz_hosting.core.events.on_server_updated",
+            "appz_hosting.core.check_schedule.expedite",
+        ],
+    },
+    "AppZ Server": {
+        "on_update": "appz_hosting.core.check_schedule.expedite",
+    },
+    "Client Site": {
+        "on_update": "appz_hosting.core.check_schedule.expedite",
     },
     "Deployed App": {
         "after_insert": "appz_hosting.core.events.on_app_created",
+        "on_update": [
+            "appz_hosting.core.tls.invalidate_domain_index",
+            "appz_hosting.core.capacity.on_app_change",
+        ],
+        "on_trash": [
+            "appz_hosting.core.tls.invalidate_domain_index",
+            "appz_hosting.core.capacity.on_app_change",
+        ],
+    },
+    "Hosted Service": {
+        "on_update": [
+            "appz_hosting.core.tls.invalidate_domain_index",
+            "appz_hosting.core.capacity.on_service_change",
+        ],
+        "on_trash": [
+            "appz_hosting.core.tls.invalidate_domain_index",
+            "appz_hosting.core.capacity.on_service_change",
+        ],
+    },
+    "App Template": {
+        "on_update": "appz_hosting.core.events.on_template_updated",
     },
 }
 